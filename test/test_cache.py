@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from torexpress import cache
+from torexpress.cache import Memmory, Dummy, create_cache, get_generation, bump_generation
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class MemmoryTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self._time = cache.time
+        cache.time = self.clock
+
+    def tearDown(self):
+        cache.time = self._time
+
+    def test_lru_eviction(self):
+        c = Memmory(max_size=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(c.get('a'), 1)  # 'b' is the least recently used now.
+        c.set('c', 3)
+        self.assertEqual((c.get('a'), c.get('b'), c.get('c')), (1, None, 3))
+        self.assertEqual(c.stats(), {'size': 2, 'max_size': 2, 'hits': 3, 'misses': 1, 'evictions': 1})
+
+    def test_set_existing_key_does_not_evict(self):
+        c = Memmory(max_size=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.set('a', 10)
+        self.assertEqual((c.get('a'), c.get('b'), c.evictions), (10, 2, 0))
+
+    def test_ttl_expiry(self):
+        c = Memmory(max_size=10, default_ttl=30)
+        c.set('default', 1)
+        c.set('short', 2, ttl=5)
+        c.set('forever', 3, ttl=0)
+        self.clock.now += 10
+        self.assertEqual((c.get('default'), c.get('short'), c.get('forever')), (1, None, 3))
+        self.assertFalse(c.has_key('short'))
+        self.clock.now += 30
+        self.assertEqual((c.get('default'), c.get('forever')), (None, 3))
+        self.assertTrue(c.has_key('forever'))
+
+    def test_remove_and_clear(self):
+        c = Memmory()
+        c.set('a', 1)
+        c.set('b', 2)
+        c.remove('a')
+        self.assertEqual((c.get('a'), len(c)), (None, 1))
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+
+class CreateCacheTest(unittest.TestCase):
+    def test_backends(self):
+        self.assertIsInstance(create_cache(None), Dummy)
+        self.assertIsInstance(create_cache('unknown'), Dummy)
+        c = create_cache({'backend': 'memory', 'max_size': 5, 'default_ttl': 30})
+        self.assertIsInstance(c, Memmory)
+        self.assertEqual((c.max_size, c.default_ttl), (5, 30))
+        self.assertIs(create_cache(c), c)
+
+    def test_generations(self):
+        c = Memmory()
+        generation = get_generation(c, 'users')
+        self.assertEqual(get_generation(c, 'users'), generation)
+        bump_generation(c, 'users')
+        self.assertNotEqual(get_generation(c, 'users'), generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
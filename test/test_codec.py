@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import uuid
+import decimal
+import datetime
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from torexpress.codec import binary_codecs, msgpack, get_json_codec, JSON_CODECS
+
+
+class JSONCodecTest(unittest.TestCase):
+    def test_dumps_str(self):
+        obj = {'name': u'\u4e2d\u6587', 'created': datetime.datetime(2014, 4, 18, 12, 30, 15)}
+        for codec_cls in JSON_CODECS:
+            try:
+                codec = get_json_codec(codec_cls.name)
+            except Exception:
+                continue  # Not installed.
+            s = codec.dumps(obj)
+            self.assertIsInstance(s, basestring)
+            self.assertEqual(codec.loads(s)['name'], obj['name'])
+
+
+@unittest.skipUnless('msgpack' in binary_codecs, 'msgpack is not installed.')
+class MsgpackCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.codec = binary_codecs['msgpack']
+
+    def test_strings_are_not_bin(self):
+        data = self.codec.dumps({'__limit': 10, 'User': [{'name': 'user1', u'fullname': u'User 1'}]})
+        self.assertNotIn('\xc4', data)
+        result = msgpack.unpackb(data, raw=False)
+        self.assertEqual(result, {u'__limit': 10, u'User': [{u'name': u'user1', u'fullname': u'User 1'}]})
+        self.assertTrue(all(isinstance(k, unicode) for k in result))
+
+    def test_round_trip_ext_types(self):
+        obj = {
+            'datetime': datetime.datetime(2014, 4, 18, 12, 30, 15, 500),
+            'date': datetime.date(2014, 4, 18),
+            'time': datetime.time(12, 30, 15, 500),
+            'uuid': uuid.UUID('12345678123456781234567812345678'),
+            'decimal': decimal.Decimal('1.25'),
+        }
+        self.assertEqual(self.codec.loads(self.codec.dumps(obj)), obj)
+
+
+if __name__ == '__main__':
+    unittest.main()
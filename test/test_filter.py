@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import datetime
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy.orm import Session, relationship
+from sqlalchemy.ext.declarative import declarative_base
+from torexpress import handler
+from torexpress.handler import compile_filter, build_filter, FilterExpression
+from torexpress.exceptions import InvalidExpression
+
+
+Base = declarative_base()
+
+
+class Group(Base):
+    __tablename__ = 'groups'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    users = relationship('User', backref='group')
+
+
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), nullable=False)
+    created = Column(DateTime, nullable=False)
+    group_id = Column(Integer, ForeignKey('groups.id'), nullable=True)
+
+
+class CompileFilterTest(unittest.TestCase):
+    def setUp(self):
+        handler._compiled_filters_.clear()
+
+    def test_compile(self):
+        compiled = compile_filter(User, 'name__not__startswith')
+        self.assertIsInstance(compiled, FilterExpression)
+        self.assertEqual((compiled.op, compiled.negate, compiled.joins), ('startswith', True, ()))
+        compiled = compile_filter(User, 'group.name')
+        self.assertEqual((compiled.op, compiled.negate, compiled.joins), ('', False, (User.group,)))
+        compiled = compile_filter(User, 'created__year__gte')
+        self.assertEqual((compiled.op, compiled.convert), ('gte', int))
+
+    def test_not_a_filter(self):
+        self.assertIsNone(compile_filter(User, 'unknown'))
+        self.assertIsNone(compile_filter(User, 'group'))  # A relationship without the field.
+        self.assertIsNone(compile_filter(User, 'group.unknown'))
+
+    def test_invalid_expression(self):
+        for key in ('name__like', 'name__startswith__gt', 'created__year__contains', 'created__year__gt__lt'):
+            self.assertRaises(InvalidExpression, compile_filter, User, key)
+
+    def test_cache_hits(self):
+        compiled = compile_filter(User, 'group.name__contains')
+        hits = handler._compiled_filters_.hits
+        self.assertIs(compile_filter(User, 'group.name__contains'), compiled)
+        self.assertIs(compile_filter(User, ['group', 'name__contains']), compiled)
+        self.assertIsNone(compile_filter(User, 'unknown'))
+        self.assertIsNone(compile_filter(User, 'unknown'))  # Negative results are cached too.
+        self.assertEqual(handler._compiled_filters_.hits, hits + 3)
+        self.assertIsNot(compile_filter(Group, 'name__contains'), compiled)
+
+
+class BuildFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = Session(bind=self.engine)
+        admin, guest = Group(id=1, name='admin'), Group(id=2, name='guest')
+        t = datetime.datetime(2014, 4, 18)
+        self.session.add_all([admin, guest])
+        self.session.add_all([User(id=i, name='user%d' % i, group=admin if i % 2 else guest,
+                                   created=t.replace(year=2012 + i % 3)) for i in range(1, 8)])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def filter(self, key, value, params=None):
+        criteria, joins = build_filter(User, key, value, name='p', params=params)
+        query = self.session.query(User)
+        for j in joins or []:
+            query = query.join(j)
+        return sorted(u.id for u in query.filter(criteria).params(**(params or {})))
+
+    def test_operators(self):
+        self.assertEqual(self.filter('name', 'user3'), [3])
+        self.assertEqual(self.filter('id__in', '2,4,9'), [2, 4])
+        self.assertEqual(self.filter('id__not__in', [2, 4]), [1, 3, 5, 6, 7])
+        self.assertEqual(self.filter('id__range', '3,5'), [3, 4, 5])
+        self.assertEqual(self.filter('name__endswith', '7'), [7])
+        self.assertRaises(InvalidExpression, build_filter, User, 'id__range', '3')
+
+    def test_joins(self):
+        self.assertEqual(self.filter('group.name', 'admin'), [1, 3, 5, 7])
+        criteria, joins = build_filter(User, 'group.name', 'admin', joins=[User.group])
+        self.assertEqual(joins, [User.group, User.group])
+        self.assertEqual(build_filter(User, 'unknown', 'x'), (None, None))
+
+    def test_bound_parameters(self):
+        params = dict()
+        self.assertEqual(self.filter('id__in', '2,4', params=params), [2, 4])
+        self.assertEqual(params, {'p_0': '2', 'p_1': '4'})
+        params = dict()
+        self.assertEqual(self.filter('name__startswith', 'user', params=params), range(1, 8))
+        self.assertEqual(params, {'p': u'user%'})
+
+
+if __name__ == '__main__':
+    unittest.main()
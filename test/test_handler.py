@@ -0,0 +1,659 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import uuid
+import sqlite3
+import shutil
+import tempfile
+import unittest
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+from sqlalchemy import Column, Integer, String, ForeignKey, TypeDecorator, update, text, event
+from sqlalchemy.orm import relationship
+from sqlalchemy.sql import expression
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects.sqlite.base import SQLiteCompiler
+from torexpress.application import ExpressApplication
+from torexpress.handler import ExpressHandler, request_handler, write_ndjson, pk_chunks
+from torexpress.timing import null_recorder
+from torexpress.route import route2handler
+from torexpress.codec import binary_codecs
+
+
+Base = declarative_base()
+
+
+class Group(Base):
+    __tablename__ = 'groups'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    users = relationship('User', backref='group')
+
+
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), nullable=False, unique=True)
+    fullname = Column(String(50), nullable=True)
+    group_id = Column(Integer, ForeignKey('groups.id'), nullable=True)
+
+
+class GUID(TypeDecorator):
+    """UUID stored as hex string, loaded as uuid.UUID like UUID(as_uuid=True) of PostgreSQL."""
+    impl = String
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else (value if isinstance(value, uuid.UUID) else uuid.UUID(value)).hex
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else uuid.UUID(value)
+
+
+class Team(Base):
+    __tablename__ = 'teams'
+    id = Column(GUID(32), primary_key=True)
+    name = Column(String(50))
+
+
+class Member(Base):
+    __tablename__ = 'members'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    team_id = Column(GUID(32), ForeignKey('teams.id'), nullable=True)
+    team = relationship(Team)
+
+
+class GroupHandler(ExpressHandler):
+    class Meta:
+        table = Group
+
+
+class UserHandler(ExpressHandler):
+    class Meta:
+        table = User
+        cache_ttl = 60
+
+    @route2handler(r'rename', 'POST')
+    @request_handler
+    def rename(self, *args, **kwargs):
+        self.db_session.execute(update(User.__table__).values(fullname=self.request.arguments['fullname']))
+        return {'result': True}
+
+    @route2handler(r'broken', 'GET')
+    @request_handler
+    def broken(self, *args, **kwargs):
+        def records():
+            for i in range(150):
+                yield {'id': i}
+            raise ValueError('Broken!')
+        return records()
+
+    @route2handler(r'ungroup', 'POST')
+    @request_handler
+    def ungroup(self, *args, **kwargs):
+        self.db_session.execute(text('UPDATE users SET group_id = NULL'))
+        return {'result': True}
+
+
+class ReplicaGroupHandler(ExpressHandler):
+    class Meta:
+        table = Group
+
+    @route2handler(r'engine', 'GET', 'HEAD', 'OPTIONS', 'POST')
+    def engine(self, *args, **kwargs):
+        self.set_header('X-Engine', self.db_session.bind.pool_metrics.name)
+
+    @route2handler(r'touch', 'GET')
+    @request_handler
+    def touch(self, *args, **kwargs):
+        names = [g.name for g in self.db_session.query(Group)]
+        sess = self.stick_to_primary()
+        sess.add(Group(name='touched'))
+        return {'names': names, 'engine': sess.bind.pool_metrics.name}
+
+
+class MemberHandler(ExpressHandler):
+    class Meta:
+        table = Member
+
+
+class MemberCountHandler(ExpressHandler):
+    class Meta:
+        table = Member
+        bulk_pks = False
+
+
+def statements(engine):
+    """Collect the statements executed by engine."""
+    executed = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: executed.append(statement))
+    return executed
+
+
+def pool_threads(engine):
+    """Collect the (event, name of thread) of the checkouts and checkins of connections of engine."""
+    threads = []
+
+    def listener(name):
+        return lambda *args: threads.append((name, threading.current_thread().name))
+
+    for name in ('checkout', 'checkin'):
+        event.listen(engine.pool, name, listener(name))
+    return threads
+
+
+class HandlerTestCase(AsyncHTTPTestCase):
+    settings = {}
+
+    def get_app(self):
+        self.tmpdir = tempfile.mkdtemp()
+        settings = dict(self.settings)
+        settings.setdefault('dburi', 'sqlite:///%s' % os.path.join(self.tmpdir, 'test.db'))
+        settings.setdefault('cache', 'memory')
+        app = ExpressApplication(self.get_handlers(), **settings)
+        Base.metadata.create_all(app.db_engine)
+        session = app.new_db_session()
+        admin, guest = Group(name='admin'), Group(name='guest')
+        session.add_all([admin, guest])
+        session.add_all([User(name='user%d' % i, fullname='User %d' % i, group=admin) for i in range(7)])
+        session.commit()
+        session.close()
+        return app
+
+    def get_handlers(self):
+        return [GroupHandler.route_to('/groups'), UserHandler.route_to('/users')]
+
+    def tearDown(self):
+        super(HandlerTestCase, self).tearDown()
+        self._app.db_engine.dispose()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def get_json(self, path, **kwargs):
+        response = self.fetch(path, **kwargs)
+        self.assertEqual(response.code, 200, response.body)
+        return json.loads(response.body)
+
+
+class ReadTest(HandlerTestCase):
+    def test_handler_names(self):
+        self.assertEqual((UserHandler.__name__, GroupHandler.__name__), ('UserHandler', 'GroupHandler'))
+
+    def test_get_with_query(self):
+        result = self.get_json('/users/?__limit=2')
+        self.assertEqual(result['__count'], 2)
+        self.assertEqual(len(result['User']), 2)
+
+    def test_get_with_filter(self):
+        result = self.get_json('/users/?name=user3')
+        self.assertEqual([u['name'] for u in result['User']], ['user3'])
+
+    def test_offsets_are_not_cached(self):
+        statements = self._app.statement_cache.statements
+        self.get_json('/users/?name__startswith=user&__limit=2&__order_by=id')
+        size = len(statements)
+        for begin in range(1, 6):
+            result = self.get_json('/users/?name__startswith=user&__limit=2&__order_by=id&__begin=%d' % begin)
+            self.assertEqual([u['name'] for u in result['User']], ['user%d' % i for i in range(begin, begin + 2)
+                                                                    if i < 7])
+            self.assertEqual(result['__total'], 7)
+        self.assertEqual(len(statements), size)
+
+    def test_keyset_total(self):
+        result = self.get_json('/users/?__after=&__limit=3')
+        self.assertEqual((result['__count'], result['__total']), (3, None))
+        result = self.get_json('/users/?__after=%s&__limit=3&__total=exact' % result['__next'])
+        self.assertEqual([u['name'] for u in result['User']], ['user3', 'user4', 'user5'])
+        self.assertEqual(result['__total'], 7)
+
+    def test_collection_filter_total(self):
+        result = self.get_json('/groups/?users.name__startswith=user')
+        self.assertEqual([g['name'] for g in result['Group']], ['admin'])
+        self.assertEqual((result['__count'], result['__total']), (1, 1))
+
+    @unittest.skipUnless('msgpack' in binary_codecs, 'msgpack is not installed.')
+    def test_cache_varies_on_output_format(self):
+        response = self.fetch('/users/', headers={'Accept': 'application/x-msgpack'})
+        self.assertEqual(response.headers['Content-Type'], 'application/x-msgpack')
+        response = self.fetch('/users/')
+        self.assertTrue(response.headers['Content-Type'].startswith('application/json'))
+        self.assertEqual(len(json.loads(response.body)['User']), 7)
+
+
+class CacheTest(HandlerTestCase):
+    def users(self, path='/users/?__order_by=id'):
+        return self.get_json(path)['User']
+
+    def write_behind(self, model, pk, **values):
+        """Write the database behind the handlers, the cached responses are not invalidated by it."""
+        session = self._app.new_db_session()
+        obj = session.query(model).get(pk)
+        for k, v in values.items():
+            setattr(obj, k, v)
+        session.commit()
+        session.close()
+
+    def send(self, path, method, data=None):
+        return self.get_json(path, method=method, body=json.dumps(data) if data is not None else None,
+                             headers={'Content-Type': 'application/json'})
+
+    def test_writes_invalidate_cache(self):
+        self.assertEqual(len(self.users()), 7)
+        self.write_behind(User, 1, fullname='Behind')
+        self.assertEqual(self.users()[0]['fullname'], 'User 0')  # From cache.
+        self.send('/users/', 'POST', {'name': 'new'})
+        users = self.users()
+        self.assertEqual((len(users), users[0]['fullname']), (8, 'Behind'))
+        self.send('/users/1', 'PUT', {'fullname': 'Put'})
+        self.assertEqual(self.users()[0]['fullname'], 'Put')
+        self.send('/users/1', 'DELETE')
+        self.assertEqual([u['name'] for u in self.users()][:2], ['user1', 'user2'])
+
+    def test_related_writes_invalidate_cache(self):
+        path = '/users/?__order_by=id&__extend_fields=group'
+        self.assertEqual(self.users(path)[0]['group']['name'], 'admin')
+        self.write_behind(Group, 1, name='behind')
+        self.assertEqual(self.users(path)[0]['group']['name'], 'admin')  # From cache.
+        self.send('/groups/2', 'PUT', {'name': 'renamed'})
+        self.assertEqual(self.users(path)[0]['group']['name'], 'behind')
+
+
+class StreamTest(HandlerTestCase):
+    def test_stream(self):
+        result = self.get_json('/users/?__stream=1&__order_by=id')
+        self.assertEqual([u['name'] for u in result['User']], ['user%d' % i for i in range(7)])
+        self.assertEqual(result['__count'], 7)
+
+    def test_ndjson(self):
+        response = self.fetch('/users/?ndjson&__order_by=id')
+        self.assertEqual(response.code, 200, response.body)
+        self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(x)['name'] for x in response.body.splitlines()], ['user%d' % i for i in range(7)])
+
+    def test_error_after_headers_written(self):
+        response = self.fetch('/users/broken?ndjson')
+        self.assertEqual(response.code, 599)  # The chunked body is not ended.
+        self.assertIsNotNone(response.error)
+
+
+class Dummy(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SlowClientHandler(object):
+    """A handler of which the flushes complete only when `flushed()` is called."""
+    def __init__(self):
+        self.request = Dummy(method='GET', connection=Dummy(stream=Dummy(closed=lambda: False)))
+        self.application = Dummy(db_executor=None)
+        self.json_codec = json
+        self.timing = null_recorder
+        self.output = []
+        self.callbacks = []
+
+    def set_header(self, name, value):
+        pass
+
+    def write(self, chunk):
+        self.output.append(chunk)
+
+    def flush(self, callback=None):
+        self.callbacks.append(callback)
+
+    def flushed(self):
+        self.callbacks.pop(0)()
+
+
+class FlowControlTest(AsyncTestCase):
+    def records(self, n):
+        for i in range(n):
+            self.fetched += 1
+            yield {'id': i}
+
+    @gen_test
+    def test_waits_for_flush(self):
+        self.fetched = 0
+        handler = SlowClientHandler()
+        future = write_ndjson(handler, self.records(5), chunk_size=2)
+        self.assertEqual((self.fetched, len(handler.output)), (2, 1))
+        handler.flushed()
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual((self.fetched, len(handler.output)), (4, 2))
+        handler.flushed()
+        yield gen.Task(self.io_loop.add_callback)
+        handler.flushed()
+        yield future
+        self.assertEqual(''.join(handler.output), ''.join('{"id": %d}\n' % i for i in range(5)))
+
+    @gen_test
+    def test_stops_when_closed(self):
+        self.fetched = 0
+        handler = SlowClientHandler()
+        future = write_ndjson(handler, self.records(5), chunk_size=2)
+        handler._flush_future_.set_result(False)  # As ExpressHandler.on_connection_close does.
+        yield future
+        self.assertEqual((self.fetched, len(handler.output)), (2, 1))
+
+
+class ExecutorStreamTest(StreamTest):
+    settings = {'db_workers': 1}  # Connections of SQLite can only be used in the thread created them.
+
+    def test_checkin_on_executor(self):
+        threads = pool_threads(self._app.db_engine)
+        self.get_json('/users/?__stream=1')
+        self.assertEqual(self.fetch('/users/broken?ndjson').code, 599)
+        self.assertEqual(sorted(set(x[0] for x in threads)), ['checkin', 'checkout'])
+        self.assertNotIn(threading.current_thread().name, set(x[1] for x in threads))
+
+
+class WriteTest(HandlerTestCase):
+    def post_json(self, path, data):
+        return self.get_json(path, method='POST', body=json.dumps(data), headers={'Content-Type': 'application/json'})
+
+    def query_users(self):
+        session = self._app.new_db_session()
+        try:
+            return session.query(User).all()
+        finally:
+            session.close()
+
+    def test_execute_is_committed(self):
+        self.post_json('/users/rename', {'fullname': 'Renamed'})
+        self.assertEqual(set(u.fullname for u in self.query_users()), set(['Renamed']))
+
+    def test_textual_execute_is_committed(self):
+        self.post_json('/users/ungroup', {})
+        self.assertEqual(set(u.group_id for u in self.query_users()), set([None]))
+
+    def test_output_flags_are_not_filters(self):
+        response = self.fetch('/users/?ndjson', method='PUT', body=json.dumps({'fullname': 'X'}),
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 400, response.body)
+        self.assertNotIn('X', [u.fullname for u in self.query_users()])
+        response = self.fetch('/users/?ndjson', method='POST', body=json.dumps({'name': 'new', 'fullname': 'X'}),
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 200, response.body)
+        self.assertEqual([u.name for u in self.query_users() if u.fullname == 'X'], ['new'])
+
+    def test_binary_flags_are_not_filters(self):
+        for name in ('msgpack', 'cbor'):
+            response = self.fetch('/users/?%s' % name, method='PUT', body=json.dumps({'fullname': 'X'}),
+                                  headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.code, 400, response.body)
+            self.assertEqual(self.fetch('/users/?%s' % name, method='DELETE').code, 400)
+            response = self.fetch('/users/?%s' % name, method='POST', body=json.dumps({'name': name}),
+                                  headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.code, 200, response.body)
+        self.assertEqual([u.name for u in self.query_users()][7:], ['msgpack', 'cbor'])
+        self.assertNotIn('X', [u.fullname for u in self.query_users()])
+
+    def test_write_without_filters(self):
+        response = self.fetch('/users/?__limit=1&unknown=1', method='PUT', body=json.dumps({'fullname': 'X'}),
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 400, response.body)
+        self.assertEqual(self.fetch('/users/?__limit=1', method='DELETE').code, 400)
+        self.assertEqual(len(self.query_users()), 7)
+        self.assertNotIn('X', [u.fullname for u in self.query_users()])
+
+    def test_bulk_create_keeps_order(self):
+        rows = [{'name': 'a'}, {'name': 'b', 'fullname': 'B'}, {'name': 'c'}, {'name': 'd', 'fullname': 'D'}]
+        result = self.post_json('/users/?__bulk=1', rows)
+        names = dict((u.id, u.name) for u in self.query_users())
+        self.assertEqual([names[r['id']] for r in result['User']], ['a', 'b', 'c', 'd'])
+
+
+class RelatedTest(HandlerTestCase):
+    team_id = uuid.UUID('12345678123456781234567812345678')
+
+    def get_handlers(self):
+        return [MemberHandler.route_to('/members'), MemberCountHandler.route_to('/member-count')]
+
+    def setUp(self):
+        super(RelatedTest, self).setUp()
+        session = self._app.new_db_session()
+        session.add(Team(id=self.team_id, name='team'))
+        session.commit()
+        session.close()
+
+    def post(self, path, data):
+        return self.fetch(path, method='POST', body=json.dumps(data), headers={'Content-Type': 'application/json'})
+
+    def members(self):
+        session = self._app.new_db_session()
+        try:
+            return [(m.name, m.team_id) for m in session.query(Member).order_by(Member.id)]
+        finally:
+            session.close()
+
+    def test_non_integer_pk(self):
+        response = self.post('/members/', {'name': 'a', 'team': str(self.team_id)})
+        self.assertEqual(response.code, 200, response.body)
+        response = self.post('/members/', {'name': 'b', 'team': {'id': self.team_id.hex.upper()}})
+        self.assertEqual(response.code, 200, response.body)
+        self.assertEqual(self.post('/members/', {'name': 'c', 'team': str(uuid.uuid4())}).code, 404)
+        self.assertEqual(self.members(), [('a', self.team_id), ('b', self.team_id)])
+
+    def test_bulk_non_integer_pk(self):
+        rows = [{'name': 'a', 'team': str(self.team_id)}, {'name': 'b', 'team': {'id': self.team_id.hex}}]
+        response = self.post('/members/?__bulk=1', rows)
+        self.assertEqual(response.code, 200, response.body)
+        self.assertEqual(len(json.loads(response.body)['Member']), 2)
+        self.assertEqual(self.post('/members/?__bulk=1', [{'name': 'c', 'team': str(uuid.uuid4())}]).code, 404)
+        self.assertEqual(self.members(), [('a', self.team_id), ('b', self.team_id)])
+
+    def test_bulk_without_pks(self):
+        inserts = []
+        event.listen(self._app.db_engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, parameters, context, executemany:
+                     inserts.append(executemany) if statement.startswith('INSERT') else None)
+        response = self.post('/member-count/?__bulk=1', [{'name': 'm%d' % i} for i in range(5)])
+        self.assertEqual(response.code, 200, response.body)
+        self.assertEqual(json.loads(response.body)['__count'], 5)
+        self.assertNotIn('Member', json.loads(response.body))
+        self.assertEqual(inserts, [True])
+        self.assertEqual([m[0] for m in self.members()], ['m%d' % i for i in range(5)])
+
+
+class ReplicaTest(HandlerTestCase):
+    def get_app(self):
+        self.replica_dir = tempfile.mkdtemp()
+        self.settings = {'dbreplicas': ['sqlite:///%s' % os.path.join(self.replica_dir, 'replica%d.db' % i)
+                                        for i in range(2)]}
+        app = super(ReplicaTest, self).get_app()
+        # Only replica0 has the tables, reading replica1 fails.
+        Base.metadata.create_all(app.db_replica_engines[0])
+        app.db_replica_engines[0].execute(Group.__table__.insert(), name='replica0')
+        return app
+
+    def get_handlers(self):
+        return [ReplicaGroupHandler.route_to('/groups')]
+
+    def tearDown(self):
+        super(ReplicaTest, self).tearDown()
+        for engine in self._app.db_replica_engines:
+            engine.dispose()
+        shutil.rmtree(self.replica_dir, ignore_errors=True)
+
+    def engine(self, method):
+        response = self.fetch('/groups/engine', method=method, body='{}' if method == 'POST' else None,
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 200, response.body)
+        return response.headers['X-Engine']
+
+    def group_names(self):
+        return [g['name'] for g in self.get_json('/groups/')['Group']]
+
+    def test_read_methods_use_replicas(self):
+        self.assertEqual([self.engine(m) for m in ('GET', 'HEAD', 'OPTIONS')], ['replica1', 'replica0', 'replica1'])
+        self.assertEqual(self.engine('POST'), 'primary')
+
+    def test_writes_use_primary(self):
+        self.get_json('/groups/', method='POST', body=json.dumps({'name': 'new'}),
+                      headers={'Content-Type': 'application/json'})
+        session = self._app.new_db_session()
+        self.assertEqual([g.name for g in session.query(Group)], ['admin', 'guest', 'new'])
+        session.close()
+
+    def test_stick_to_primary(self):
+        self._app.replica_router.eject(self._app.db_replica_engines[1])
+        self.assertEqual(self.get_json('/groups/touch'), {'names': ['replica0'], 'engine': 'primary'})
+        session = self._app.new_db_session()
+        self.assertEqual([g.name for g in session.query(Group)], ['admin', 'guest', 'touched'])
+        session.close()
+
+    def test_ejection_and_fallback(self):
+        self.assertEqual(self.fetch('/groups/').code, 500)  # replica1 fails and is ejected.
+        self.assertEqual(self._app.replica_router.healthy(), self._app.db_replica_engines[:1])
+        self.assertEqual([self.group_names() for i in range(2)], [['replica0'], ['replica0']])
+        self._app.replica_router.eject(self._app.db_replica_engines[0])
+        self.assertEqual(self.group_names(), ['admin', 'guest'])  # All the replicas are ejected.
+
+
+class BulkWriteTest(HandlerTestCase):
+    returning = False
+
+    def setUp(self):
+        super(BulkWriteTest, self).setUp()
+        self.executed = statements(self._app.db_engine)
+
+    def users(self):
+        session = self._app.new_db_session()
+        try:
+            return [(u.name, u.fullname) for u in session.query(User).order_by(User.id)]
+        finally:
+            session.close()
+
+    def writes(self, kind):
+        return [x for x in self.executed if x.startswith(kind)]
+
+    def test_update_by_query(self):
+        result = self.get_json('/users/?name__in=user1,user5', method='PUT', body=json.dumps({'fullname': 'X'}),
+                               headers={'Content-Type': 'application/json'})
+        self.assertEqual(sorted((u['name'], u['fullname']) for u in result['User']), [('user1', 'X'), ('user5', 'X')])
+        self.assertEqual([u[0] for u in self.users() if u[1] == 'X'], ['user1', 'user5'])
+        self.assertEqual(len(self.writes('UPDATE')), 1)
+        self.assertEqual('RETURNING' in self.writes('UPDATE')[0], self.returning)
+
+    def test_delete_by_query(self):
+        result = self.get_json('/users/?name__in=user1,user5', method='DELETE')
+        self.assertEqual(sorted(u['id'] for u in result['User']), [2, 6])
+        self.assertEqual([u[0] for u in self.users()], ['user0', 'user2', 'user3', 'user4', 'user6'])
+        self.assertEqual(len(self.writes('DELETE')), 1)
+        self.assertEqual('RETURNING' in self.writes('DELETE')[0], self.returning)
+
+    def test_cache_is_invalidated(self):
+        self.assertEqual(len(self.get_json('/users/')['User']), 7)
+        self.get_json('/users/?name__in=user1,user5', method='PUT', body=json.dumps({'fullname': 'X'}),
+                      headers={'Content-Type': 'application/json'})
+        self.assertEqual([u['name'] for u in self.get_json('/users/')['User'] if u['fullname'] == 'X'],
+                         ['user1', 'user5'])
+        self.get_json('/users/?fullname=X', method='DELETE')
+        self.assertEqual(len(self.get_json('/users/')['User']), 5)
+
+    def test_pk_chunks(self):
+        session = self._app.new_db_session()
+        try:
+            query = session.query(User).filter(User.name != 'user3')
+            for size, lengths in ((2, [2, 2, 2]), (4, [4, 2]), (6, [6]), (10, [6])):
+                chunks = list(pk_chunks(query, [User.id], chunk_size=size))
+                self.assertEqual([len(x) for x in chunks], lengths)
+                self.assertEqual([x[0] for c in chunks for x in c], [1, 2, 3, 5, 6, 7])
+        finally:
+            session.close()
+
+
+class ReturningCompiler(SQLiteCompiler):
+    """RETURNING of SQLite 3.35+ which SQLAlchemy 0.8 does not compile, as it's compiled for PostgreSQL."""
+    def returning_clause(self, stmt, returning_cols):
+        return 'RETURNING ' + ', '.join(self._label_select_column(None, c, True, False, {})
+                                        for c in expression._select_iterables(returning_cols))
+
+
+@unittest.skipUnless(sqlite3.sqlite_version_info >= (3, 35), 'RETURNING is not supported by SQLite.')
+class ReturningBulkWriteTest(BulkWriteTest):
+    returning = True
+
+    def setUp(self):
+        super(ReturningBulkWriteTest, self).setUp()
+        dialect = self._app.db_engine.dialect
+        dialect.statement_compiler = ReturningCompiler
+        dialect.update_returning = dialect.delete_returning = True
+
+
+class MaxAffectedRowsTest(BulkWriteTest):
+    settings = {'max_affected_rows': 2}
+
+    def test_guard(self):
+        self.get_json('/users/?name__in=user1,user5', method='PUT', body=json.dumps({'fullname': 'X'}),
+                      headers={'Content-Type': 'application/json'})
+        response = self.fetch('/users/?name__startswith=user', method='PUT', body=json.dumps({'fullname': 'Y'}),
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 400, response.body)
+        self.assertEqual(self.fetch('/users/?fullname__startswith=User', method='DELETE').code, 400)
+        self.assertEqual(len(self.writes('UPDATE')), 1)  # The rejected writes never run.
+        self.assertEqual(self.writes('DELETE'), [])
+        self.assertEqual([u[0] for u in self.users() if u[1] == 'X'], ['user1', 'user5'])
+        self.assertEqual(len(self.users()), 7)
+
+
+class ExecutorTest(HandlerTestCase):
+    settings = {'db_workers': 2}
+
+    def test_read_does_not_commit(self):
+        commits = []
+        event.listen(self._app.db_engine, 'commit', lambda conn: commits.append(conn))
+        self.get_json('/users/?__limit=2')
+        self.assertEqual(commits, [])
+
+    def test_cache_hit_does_not_checkout(self):
+        self.get_json('/users/?__limit=2')
+        checkouts = self._app.db_engine.pool_metrics.checkouts
+        self.get_json('/users/?__limit=2')
+        self.assertEqual(self._app.db_engine.pool_metrics.checkouts, checkouts)
+
+    def test_checkin_on_executor(self):
+        threads = pool_threads(self._app.db_engine)
+        self.get_json('/users/?__limit=2&__order_by=id')
+        self.get_json('/users/1', method='PUT', body=json.dumps({'fullname': 'Renamed'}),
+                      headers={'Content-Type': 'application/json'})
+        self.assertEqual(self.fetch('/users/100').code, 404)
+        self.assertEqual(sorted(set(x[0] for x in threads)), ['checkin', 'checkout'])
+        self.assertNotIn(threading.current_thread().name, set(x[1] for x in threads))
+
+    def test_write_is_committed(self):
+        self.get_json('/users/1', method='PUT', body=json.dumps({'fullname': 'Renamed'}),
+                      headers={'Content-Type': 'application/json'})
+        session = self._app.new_db_session()
+        self.assertEqual(session.query(User).get(1).fullname, 'Renamed')
+        session.close()
+
+
+class MetricsTest(HandlerTestCase):
+    settings = {'metrics': True}
+
+    def get_handlers(self):
+        return super(MetricsTest, self).get_handlers() + [GroupHandler.route_to()]  # A catch-all route.
+
+    def test_metrics_route(self):
+        self.get_json('/users/?__limit=2')
+        self.get_json('/users/?__limit=2')  # From cache.
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200, response.body)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('torexpress_requests_total{handler="UserHandler",method="GET",route="",status="200"} 2\n',
+                      response.body)
+        self.assertIn('torexpress_rows_total{handler="UserHandler",route=""} 4\n', response.body)
+
+    def test_metrics_labels(self):
+        self.get_json('/users/rename', method='POST', body=json.dumps({'fullname': 'Renamed'}),
+                      headers={'Content-Type': 'application/json'})
+        self.assertEqual(self.fetch('/users/abc').code, 404)
+        body = self.fetch('/metrics').body
+        self.assertIn('torexpress_request_duration_seconds_count{handler="UserHandler",route="rename$"} 1\n', body)
+        self.assertIn('torexpress_errors_total{error="NotFound",handler="UserHandler",route=""} 1\n', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
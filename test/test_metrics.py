@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from torexpress.metrics import Metrics, _labels_
+
+
+class LabelsTest(unittest.TestCase):
+    def test_labels(self):
+        self.assertEqual(_labels_(route='', handler='H'), 'handler="H",route=""')
+        self.assertEqual(_labels_(route='a"b\\c\nd'), 'route="a\\"b\\\\c\\nd"')
+
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 0.5, 1))
+        self.metrics.observe('UserHandler', '', 'GET', 200, 0.05, rows=3)
+        self.metrics.observe('UserHandler', '', 'GET', 200, 0.3, rows=2)
+        self.metrics.observe('UserHandler', '', 'GET', 404, 2, error='NotFound')
+        self.metrics.observe('UserHandler', 'rename$', 'POST', 200, 0.5, rows=0)
+
+    def test_empty(self):
+        lines = Metrics().render().splitlines()
+        self.assertTrue(all(x.startswith('# ') for x in lines))
+        self.assertEqual([x.split()[2] for x in lines if x.startswith('# TYPE')],
+                         ['torexpress_requests_total', 'torexpress_request_duration_seconds',
+                          'torexpress_errors_total', 'torexpress_rows_total'])
+
+    def test_counters(self):
+        body = self.metrics.render()
+        self.assertTrue(body.endswith('\n'))
+        self.assertIn('torexpress_requests_total{handler="UserHandler",method="GET",route="",status="200"} 2\n', body)
+        self.assertIn('torexpress_requests_total{handler="UserHandler",method="GET",route="",status="404"} 1\n', body)
+        self.assertIn('torexpress_errors_total{error="NotFound",handler="UserHandler",route=""} 1\n', body)
+        self.assertIn('torexpress_rows_total{handler="UserHandler",route=""} 5\n', body)
+        self.assertNotIn('torexpress_rows_total{handler="UserHandler",route="rename$"}', body)
+
+    def test_histogram(self):
+        lines = [x for x in self.metrics.render().splitlines()
+                 if x.startswith('torexpress_request_duration_seconds') and 'route=""' in x]
+        self.assertEqual(lines, [
+            'torexpress_request_duration_seconds_bucket{handler="UserHandler",route="",le="0.1"} 1',
+            'torexpress_request_duration_seconds_bucket{handler="UserHandler",route="",le="0.5"} 2',
+            'torexpress_request_duration_seconds_bucket{handler="UserHandler",route="",le="1"} 2',
+            'torexpress_request_duration_seconds_bucket{handler="UserHandler",route="",le="+Inf"} 3',
+            'torexpress_request_duration_seconds_sum{handler="UserHandler",route=""} 2.350000',
+            'torexpress_request_duration_seconds_count{handler="UserHandler",route=""} 3',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import uuid
+import decimal
+import datetime
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, asc, desc
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.declarative import declarative_base
+from torexpress.helpers import encode_cursor, decode_cursor
+from torexpress.handler import build_keyset, keyset_filter
+from torexpress.exceptions import InvalidExpression
+
+
+Base = declarative_base()
+
+
+class Article(Base):
+    __tablename__ = 'articles'
+    id = Column(Integer, primary_key=True)
+    author = Column(String(50), nullable=False)
+    created = Column(DateTime, nullable=False)
+
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        values = (1, u'fangze', None, 1.5, datetime.datetime(2014, 4, 18, 12, 30, 15, 500),
+                  datetime.date(2014, 4, 18), datetime.time(12, 30), decimal.Decimal('1.25'),
+                  uuid.UUID('12345678123456781234567812345678'))
+        cursor = encode_cursor(values)
+        self.assertRegexpMatches(cursor, r'^[A-Za-z0-9_=-]+$')
+        self.assertEqual(tuple(decode_cursor(cursor)), values)
+
+    def test_invalid(self):
+        for cursor in ('not a cursor', encode_cursor([1])[:-2], 'eyJhIjoxfQ==', 'W3siJHgiOjF9XQ=='):
+            self.assertRaises(ValueError, decode_cursor, cursor)
+
+
+class KeysetTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = Session(bind=self.engine)
+        t = datetime.datetime(2014, 4, 18)
+        self.session.add_all([Article(id=i, author='author%d' % (i % 3), created=t + datetime.timedelta(days=i % 4))
+                              for i in range(1, 21)])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_build_keyset(self):
+        self.assertEqual(build_keyset(Article, None), [(Article.id, False)])
+        self.assertEqual(build_keyset(Article, ['-created', 'unknown', 'created']),
+                         [(Article.created, True), (Article.id, True)])
+        self.assertEqual(build_keyset(Article, ['author', '-id']), [(Article.author, False), (Article.id, True)])
+
+    def walk(self, order_by, dialect_name, limit=3):
+        keys = build_keyset(Article, order_by)
+        query = self.session.query(Article).order_by(*[desc(c) if d else asc(c) for c, d in keys])
+        result, cursor = list(), None
+        while True:
+            inst = query
+            if cursor:
+                inst = inst.filter(keyset_filter(keys, decode_cursor(cursor), dialect_name))
+            rows = inst.limit(limit).all()
+            result.extend(r.id for r in rows)
+            if len(rows) < limit:
+                return result
+            cursor = encode_cursor([getattr(rows[-1], c.key) for c, d in keys])
+
+    def test_walk(self):
+        for order_by in (None, ['author'], ['-created'], ['created', 'author'], ['-author', 'created']):
+            expected = [r.id for r in self.session.query(Article).order_by(
+                *[desc(c) if d else asc(c) for c, d in build_keyset(Article, order_by)])]
+            for dialect_name in (None, 'sqlite'):  # By row values and expanded criteria.
+                self.assertEqual(self.walk(order_by, dialect_name), expected, (order_by, dialect_name))
+
+    def test_invalid_cursor_length(self):
+        keys = build_keyset(Article, ['author'])
+        self.assertRaises(InvalidExpression, keyset_filter, keys, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
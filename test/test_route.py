@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from torexpress.handler import URLSpec, RouteDispatcher, literal_first_segment
+
+
+class LiteralFirstSegmentTest(unittest.TestCase):
+    def test_segments(self):
+        self.assertEqual(literal_first_segment(r'login'), 'login')
+        self.assertEqual(literal_first_segment(r'login$'), 'login')
+        self.assertEqual(literal_first_segment(r'^login/(?P<uid>[0-9]+)$'), 'login')
+        self.assertEqual(literal_first_segment(r'_schema'), '_schema')
+        self.assertIsNone(literal_first_segment(r'(?P<uid>[0-9]+)/login'))
+        self.assertIsNone(literal_first_segment(r'log.n'))
+        self.assertIsNone(literal_first_segment(r'login|logout'))
+
+
+class RouteDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.specs = [
+            URLSpec(r'login', 'login', ['POST']),
+            URLSpec(r'(?P<uid>[0-9]+)/login', 'uid_login'),
+            URLSpec(r'login/(?P<name>\w+)', 'login_name'),
+            URLSpec(r'\w+/stats', 'stats'),
+            URLSpec(r'login/admin', 'login_admin'),
+        ]
+        self.pk_spec = URLSpec(r'(?P<id>[0-9]+)', None)
+        self.dispatcher = RouteDispatcher(self.specs, self.pk_spec)
+
+    def match(self, path):
+        spec, match = self.dispatcher.match(path)
+        return (spec.request_handler if spec is not self.pk_spec else 'pk') if spec else None, \
+            match.groupdict() if match else None
+
+    def test_literal_routes(self):
+        self.assertEqual(self.match('login'), ('login', {}))
+        self.assertEqual(self.match('login/fangze'), ('login_name', {'name': 'fangze'}))
+
+    def test_declaration_order(self):
+        # Both login/(?P<name>\w+) and login/admin match, the one declared first wins.
+        self.assertEqual(self.match('login/admin'), ('login_name', {'name': 'admin'}))
+        # Routes can not be indexed are tried together with the indexed ones in order.
+        self.assertEqual(self.match('login/stats'), ('login_name', {'name': 'stats'}))
+        self.assertEqual(self.match('users/stats'), ('stats', {}))
+
+    def test_unindexed_routes(self):
+        self.assertEqual(self.match('12/login'), ('uid_login', {'uid': '12'}))
+
+    def test_pk_spec_is_the_last(self):
+        self.assertEqual(self.match('12'), ('pk', {'id': '12'}))
+        self.assertEqual(self.match('unknown'), (None, None))
+
+    def test_same_as_linear_matching(self):
+        def linear(path):
+            for spec in self.specs + [self.pk_spec]:
+                match = spec.regex.match(path)
+                if match:
+                    return spec
+            return None
+        for path in ('login', 'login/', 'login/admin', 'login/a/b', '12/login', 'x/stats', '12', 'stats', ''):
+            self.assertIs(self.dispatcher.match(path)[0], linear(path), path)
+
+
+if __name__ == '__main__':
+    unittest.main()
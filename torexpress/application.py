@@ -1,6 +1,9 @@
 from tornado.web import Application
 import logging
-from .cache import Dummy
+from .cache import create_cache
+from .codec import get_json_codec
+from .timing import create_timing_sinks
+from .metrics import Metrics, MetricsHandler
 _logger = logging.getLogger('tornado.torexpress')
 
 
@@ -11,23 +14,73 @@ class ExpressApplication(Application):
 
     def __init__(self, handlers=None, default_host="", transforms=None,
                  wsgi=False, **settings):
+        if settings.get('metrics'):
+            # Opt-in: request metrics of handlers are served in Prometheus text format at `metrics_path`, the route
+            # goes first so it's not shadowed by catch-all routes, eg: ExpressHandler.route_to().
+            self.metrics = Metrics(buckets=settings.get('metrics_buckets'))
+            handlers = [(settings.get('metrics_path', '/metrics'), MetricsHandler)] + list(handlers or [])
+        else:
+            self.metrics = None
         super(ExpressApplication, self).__init__(handlers=handlers, default_host=default_host,
                                                  transforms=transforms, wsgi=wsgi, **settings)
         if settings.get('dburi'):
             from sqlalchemy.orm import sessionmaker
-            from sqlalchemy import create_engine
-            self.db_engine = create_engine(settings.get('dburi'), echo=settings.get('dblogging', False))
+            from .database import create_db_engine, ReplicaRouter, StatementCache
+            self.db_engine = create_db_engine(settings.get('dburi'), settings, name='primary')
             self.session_maker = sessionmaker(bind=self.db_engine)
+            self.db_replica_engines = [create_db_engine(uri, settings, name='replica%d' % i)
+                                       for i, uri in enumerate(settings.get('dbreplicas') or [])]
+            self.replica_router = ReplicaRouter(self.db_replica_engines,
+                                                strategy=settings.get('dbreplicas_strategy'),
+                                                eject_seconds=settings.get('dbreplicas_eject', 30)) \
+                if self.db_replica_engines else None
+            self.statement_cache = StatementCache(max_size=settings.get('statement_cache_size', 1024)) \
+                if settings.get('statement_cache', True) else None
         else:
             self.db_engine = None
             self.session_maker = None
-        if settings.get('cache'):
-            self.cache = Dummy()
+            self.db_replica_engines = []
+            self.replica_router = None
+            self.statement_cache = None
+        if settings.get('db_workers'):
+            # Database works of handlers run on this bounded executor instead of the IOLoop thread, the number of
+            # workers should not be larger than the size of connection pool.
+            from concurrent.futures import ThreadPoolExecutor
+            self.db_executor = ThreadPoolExecutor(max_workers=settings.get('db_workers'))
         else:
-            self.cache = Dummy()
+            self.db_executor = None
+        self.cache = create_cache(settings.get('cache'))
+        self.json_codec = get_json_codec(settings.get('json_codec'))
+        self.timing_sinks = create_timing_sinks(settings.get('timing'))
 
     def new_db_session(self, *args, **kwargs):
         """new_db_session: create a new db session with the default sessionmaker from application.
         """
         assert self.session_maker
-        return self.session_maker(*args, **kwargs)
\ No newline at end of file
+        return self.session_maker(*args, **kwargs)
+
+    def new_replica_session(self, *args, **kwargs):
+        """new_replica_session: create a new db session bound to a replica chosen by the replica router, for read only
+        works. The session of primary will be created if there's no replica or all replicas are ejected.
+        The chosen engine is available as `session.replica_engine` (None for primary).
+        """
+        engine = self.replica_router.choose() if self.replica_router else None
+        if engine is None:
+            sess = self.new_db_session(*args, **kwargs)
+        else:
+            kwargs['bind'] = engine
+            sess = self.session_maker(*args, **kwargs)
+        sess.replica_engine = engine
+        return sess
+
+    def db_pool_status(self):
+        """db_pool_status: return the metrics of connection pools of the primary and replica engines, eg:
+        {'primary': {'checked_out': 3, 'waits': 0, ...}, 'replica0': {...}}
+        """
+        result = dict()
+        for engine in ([self.db_engine] if self.db_engine else []) + self.db_replica_engines:
+            stats = engine.pool_metrics.stats()
+            if callable(getattr(engine.pool, 'size', None)):  # QueuePool
+                stats['pool_size'] = engine.pool.size()
+            result[engine.pool_metrics.name] = stats
+        return result
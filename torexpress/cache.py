@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
+import time
+import uuid
+import threading
+import logging
+from collections import OrderedDict
+_logger = logging.getLogger('tornado.torexpress')
 
 
 class Dummy(object):
     """
     DummyCache which implemented nothing.
     """
-    def set(self, key, value):
+    def set(self, key, value, ttl=None):
         pass
 
     def get(self, key):
@@ -17,9 +23,74 @@ class Dummy(object):
     def remove(self, key):
         pass
 
+    def clear(self):
+        pass
+
 
 class Memmory(object):
-    pass
+    """
+    Memmory: an in-process cache bounded by `max_size` entries, evicting the least recently used entry when full.
+    Every entry can have its own `ttl` (in seconds), `default_ttl` is used when `set` is called without one; None or 0
+    means the entry never expires (until it is evicted).
+    """
+    def __init__(self, max_size=1024, default_ttl=None, **kwargs):
+        assert max_size > 0
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires = (time.time() + ttl) if ttl else None
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+            elif len(self._data) >= self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._data[key] = (expires, value)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            if item[0] is not None and item[0] <= time.time():
+                self.misses += 1
+                return None
+            self._data[key] = item  # Move to the most recently used end.
+            self.hits += 1
+            return item[1]
+
+    def has_key(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False
+            if item[0] is not None and item[0] <= time.time():
+                del self._data[key]
+                return False
+            return True
+
+    def remove(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
 
 
 class Redis(object):
@@ -27,4 +98,59 @@ class Redis(object):
 
 
 class Memcached(object):
-    pass
\ No newline at end of file
+    pass
+
+
+CACHE_BACKENDS = {
+    'dummy': Dummy,
+    'memory': Memmory,
+    'memmory': Memmory,
+}
+
+
+def create_cache(conf):
+    """create_cache: create a cache backend from the `cache` setting of application.
+    `conf` can be:
+        - None or False: Dummy cache;
+        - an object already implemented get/set/has_key/remove: used as it is;
+        - a string of backend name, eg: 'memory';
+        - a dictionary with key 'backend' and the other keys as kwargs of the backend, eg:
+            {'backend': 'memory', 'max_size': 10000, 'default_ttl': 30}
+    """
+    if hasattr(conf, 'get') and hasattr(conf, 'set') and not isinstance(conf, dict):
+        return conf  # Checked first, an empty Memmory is false.
+    if not conf:
+        return Dummy()
+    if isinstance(conf, dict):
+        kwargs = dict(conf)
+        backend = kwargs.pop('backend', 'memory')
+    else:
+        kwargs = {}
+        backend = conf
+    backend_cls = CACHE_BACKENDS.get(('%s' % backend).lower())
+    if backend_cls is None:
+        _logger.warning('Cache backend "%s" is not supported, fall back to Dummy.', backend)
+        return Dummy()
+    return backend_cls(**kwargs)
+
+
+GENERATION_KEY = 'torexpress:generation:%s'
+
+
+def get_generation(cache, name):
+    """get_generation: return the current generation token of `name` (usually a table name) kept in cache.
+    Cached values built on `name` should include the generation in their keys, then bump_generation will make them
+    unreachable without scanning the cache. A fresh token is created when the generation is missing (never set or
+    evicted), so entries of an evicted generation can never be reached again.
+    """
+    key = GENERATION_KEY % name
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.set(key, generation, ttl=0)
+    return generation
+
+
+def bump_generation(cache, name):
+    """bump_generation: invalidate all cached values built on `name` by moving to a new generation."""
+    cache.set(GENERATION_KEY % name, uuid.uuid4().hex, ttl=0)
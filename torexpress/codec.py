@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+codecs for encoding responses and decoding request bodies.
+"""
+import sys
+import json as stdjson
+import uuid
+import decimal
+import datetime
+import logging
+from .serializers import ExtJsonEncoder, ext_default
+try:
+    import ujson
+except:
+    ujson = None
+try:
+    import simplejson
+except:
+    simplejson = None
+try:
+    import msgpack
+except:
+    msgpack = None
+try:
+    import cbor2
+except:
+    cbor2 = None
+_logger = logging.getLogger('tornado.torexpress')
+
+
+class Codec(object):
+    """
+    Codec: the base class of codecs, `content_type` is used for the output and `content_types` are the Content-Type
+    and Accept values the codec can handle.
+    """
+    name = None
+    content_type = None
+    content_types = ()
+
+    def dumps(self, obj):
+        raise NotImplementedError()
+
+    def loads(self, s):
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.name)
+
+
+class JSONCodec(Codec):
+    """
+    JSONCodec: the base class of JSON codecs, the subclasses implement `dumps` and `loads` with a JSON backend and
+    keep the semantics of ExtJsonEncoder for datetime/date/time/UUID.
+    """
+    content_type = 'application/json'
+    content_types = ('application/json', )
+
+
+class UjsonCodec(JSONCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        assert ujson is not None, 'ujson is not installed.'
+        # Only the releases of ujson which support the `default` hook can keep the semantics of ExtJsonEncoder.
+        ujson.dumps(datetime.date.today(), default=ext_default)
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, default=ext_default, ensure_ascii=False)
+
+    def loads(self, s):
+        return ujson.loads(s)
+
+
+class SimplejsonCodec(JSONCodec):
+    name = 'simplejson'
+
+    def __init__(self):
+        assert simplejson is not None, 'simplejson is not installed.'
+        self._encoder = ExtJsonEncoder()
+        self._decoder = simplejson.JSONDecoder()
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+    def loads(self, s):
+        return self._decoder.decode(s)
+
+
+class StdlibJSONCodec(JSONCodec):
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = stdjson.JSONEncoder(default=ext_default)
+        self._decoder = stdjson.JSONDecoder()
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+    def loads(self, s):
+        return self._decoder.decode(s)
+
+
+JSON_CODECS = (UjsonCodec, SimplejsonCodec, StdlibJSONCodec)  # From the fastest to the slowest.
+
+
+def get_json_codec(conf=None):
+    """get_json_codec: return a JSON codec according to `conf` (the `json_codec` setting of application):
+        - None or 'auto': the fastest one of installed backends in order of ujson, simplejson and json;
+        - a name of backend: 'ujson', 'simplejson' or 'json';
+        - an object already implemented dumps/loads: used as it is.
+    """
+    if conf is not None and not isinstance(conf, basestring):
+        return conf
+    if conf in (None, 'auto'):
+        for codec_cls in JSON_CODECS:
+            try:
+                return codec_cls()
+            except Exception, e:
+                _logger.debug('JSON codec "%s" is not available: %s', codec_cls.name, e)
+    for codec_cls in JSON_CODECS:
+        if codec_cls.name == conf:
+            return codec_cls()
+    raise Exception('Unknown JSON codec "%s".' % conf)
+
+
+default_json_codec = get_json_codec()
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+DATE_FORMAT = '%Y-%m-%d'
+TIME_FORMAT = '%H:%M:%S.%f'
+
+# MessagePack extension type codes for the types round-tripped by MsgpackCodec.
+MSGPACK_EXT_DATETIME = 1
+MSGPACK_EXT_DATE = 2
+MSGPACK_EXT_TIME = 3
+MSGPACK_EXT_UUID = 4
+MSGPACK_EXT_DECIMAL = 5
+
+
+class MsgpackCodec(Codec):
+    """
+    MsgpackCodec: MessagePack codec, datetime/date/time/UUID/Decimal are packed as extension types so they can be
+    round-tripped.
+    """
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+    content_types = ('application/x-msgpack', 'application/msgpack')
+
+    def __init__(self):
+        assert msgpack is not None, 'msgpack is not installed.'
+
+    @staticmethod
+    def _default_(obj):
+        if isinstance(obj, datetime.datetime):
+            return msgpack.ExtType(MSGPACK_EXT_DATETIME, obj.strftime(DATETIME_FORMAT).encode('ascii'))
+        if isinstance(obj, datetime.date):
+            return msgpack.ExtType(MSGPACK_EXT_DATE, obj.strftime(DATE_FORMAT).encode('ascii'))
+        if isinstance(obj, datetime.time):
+            return msgpack.ExtType(MSGPACK_EXT_TIME, obj.strftime(TIME_FORMAT).encode('ascii'))
+        if isinstance(obj, uuid.UUID):
+            return msgpack.ExtType(MSGPACK_EXT_UUID, obj.bytes)
+        if isinstance(obj, decimal.Decimal):
+            return msgpack.ExtType(MSGPACK_EXT_DECIMAL, str(obj).encode('ascii'))
+        raise TypeError('%r is not MessagePack serializable' % (obj, ))
+
+    @staticmethod
+    def _ext_hook_(code, data):
+        if code == MSGPACK_EXT_DATETIME:
+            return datetime.datetime.strptime(data.decode('ascii'), DATETIME_FORMAT)
+        if code == MSGPACK_EXT_DATE:
+            return datetime.datetime.strptime(data.decode('ascii'), DATE_FORMAT).date()
+        if code == MSGPACK_EXT_TIME:
+            return datetime.datetime.strptime(data.decode('ascii'), TIME_FORMAT).time()
+        if code == MSGPACK_EXT_UUID:
+            return uuid.UUID(bytes=data)
+        if code == MSGPACK_EXT_DECIMAL:
+            return decimal.Decimal(data.decode('ascii'))
+        return msgpack.ExtType(code, data)
+
+    def dumps(self, obj):
+        # `str` of Python 2 is bytes, it would be packed as bin (keys and column names as well) with use_bin_type, the
+        # clients expect strings for them.
+        return msgpack.packb(obj, default=self._default_, use_bin_type=sys.version_info[0] >= 3)
+
+    def loads(self, s):
+        return msgpack.unpackb(s, ext_hook=self._ext_hook_, raw=False)
+
+
+# CBOR tags (in the first come first served range) for the types cbor2 does not support natively.
+CBOR_TAG_DATE = 40100
+CBOR_TAG_TIME = 40101
+
+
+class CborCodec(Codec):
+    """
+    CborCodec: CBOR codec, datetime (tag 0, naive datetimes are treated as UTC), Decimal (tag 4) and UUID (tag 37)
+    are supported natively by cbor2, date/time are encoded with private tags.
+    """
+    name = 'cbor'
+    content_type = 'application/cbor'
+    content_types = ('application/cbor', )
+
+    def __init__(self):
+        assert cbor2 is not None, 'cbor2 is not installed.'
+        if hasattr(datetime, 'timezone'):
+            self._utc = datetime.timezone.utc
+        else:
+            from cbor2.compat import timezone
+            self._utc = timezone.utc
+
+    @staticmethod
+    def _default_(encoder, obj):
+        if isinstance(obj, datetime.date) and not isinstance(obj, datetime.datetime):
+            encoder.encode(cbor2.CBORTag(CBOR_TAG_DATE, obj.strftime(DATE_FORMAT)))
+        elif isinstance(obj, datetime.time):
+            encoder.encode(cbor2.CBORTag(CBOR_TAG_TIME, obj.strftime(TIME_FORMAT)))
+        else:
+            raise TypeError('%r is not CBOR serializable' % (obj, ))
+
+    @staticmethod
+    def _tag_hook_(decoder, tag):
+        if tag.tag == CBOR_TAG_DATE:
+            return datetime.datetime.strptime(tag.value, DATE_FORMAT).date()
+        if tag.tag == CBOR_TAG_TIME:
+            return datetime.datetime.strptime(tag.value, TIME_FORMAT).time()
+        return tag
+
+    def dumps(self, obj):
+        return cbor2.dumps(obj, default=self._default_, timezone=self._utc)
+
+    def loads(self, s):
+        return cbor2.loads(s, tag_hook=self._tag_hook_)
+
+
+BINARY_CODECS = (MsgpackCodec, CborCodec)
+
+
+def get_binary_codecs():
+    """get_binary_codecs: return a dictionary of name to instance of the binary codecs which are installed."""
+    result = dict()
+    for codec_cls in BINARY_CODECS:
+        try:
+            result[codec_cls.name] = codec_cls()
+        except Exception, e:
+            _logger.debug('Codec "%s" is not available: %s', codec_cls.name, e)
+    return result
+
+
+binary_codecs = get_binary_codecs()
+
+
+def binary_codec_for(content_type):
+    """binary_codec_for: return the installed binary codec which handles `content_type`, None if there's no one."""
+    for codec in binary_codecs.values():
+        for ct in codec.content_types:
+            if content_type.startswith(ct):
+                return codec
+    return None
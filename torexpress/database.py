@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+database engines with bounded connection pools and pool metrics.
+"""
+import re
+import time
+import threading
+import logging
+import sqlalchemy
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import Session
+from sqlalchemy.util import LRUCache
+from .cache import Memmory
+_logger = logging.getLogger('tornado.torexpress')
+
+SQLALCHEMY_VERSION = tuple(int(x) for x in re.findall(r'\d+', sqlalchemy.__version__)[:2])
+
+
+class PoolMetrics(object):
+    """
+    PoolMetrics: counters of a connection pool, updated by the pool events and MeteredQueuePool.
+        - connects: number of new DBAPI connections;
+        - checkouts/checkins: number of connections checked out from/returned to the pool;
+        - checked_out: number of connections currently checked out;
+        - waits: number of checkouts which had to wait because all the connections were checked out;
+        - timeouts: number of checkouts failed with pool timeout;
+        - checkout_time/checkout_time_max: total and max seconds spent on checkout (MeteredQueuePool only).
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.checked_out = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.checkout_time = 0.0
+        self.checkout_time_max = 0.0
+        self._lock = threading.Lock()
+
+    def on_connect(self, *args):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, *args):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+
+    def on_checkin(self, *args):
+        with self._lock:
+            self.checkins += 1
+            self.checked_out -= 1
+
+    def on_wait(self):
+        with self._lock:
+            self.waits += 1
+
+    def on_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def on_checkout_time(self, seconds):
+        with self._lock:
+            self.checkout_time += seconds
+            if seconds > self.checkout_time_max:
+                self.checkout_time_max = seconds
+
+    def stats(self):
+        return {
+            'connects': self.connects,
+            'checkouts': self.checkouts,
+            'checkins': self.checkins,
+            'checked_out': self.checked_out,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+            'checkout_time': self.checkout_time,
+            'checkout_time_max': self.checkout_time_max,
+            'checkout_time_avg': (self.checkout_time / self.checkouts) if self.checkouts else 0.0,
+        }
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    MeteredQueuePool: QueuePool which measures the latency of checkouts, counts the checkouts which had to wait for a
+    connection and the ones timed out into `metrics` (a PoolMetrics).
+    """
+    def __init__(self, creator, metrics=None, **kwargs):
+        super(MeteredQueuePool, self).__init__(creator, **kwargs)
+        self.metrics = metrics or PoolMetrics()
+
+    def recreate(self):
+        pool = super(MeteredQueuePool, self).recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        if self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow:
+            self.metrics.on_wait()
+        t = time.time()
+        try:
+            return super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.metrics.on_timeout()
+            raise
+        finally:
+            self.metrics.on_checkout_time(time.time() - t)
+
+
+def _ping_connection_(dbapi_connection, connection_record, connection_proxy):
+    """Pessimistic disconnect handling: test the connection on checkout, the pool will reconnect if it's invalid."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+POOL_SETTINGS = (
+    ('dbpool_size', 'pool_size'),
+    ('dbpool_max_overflow', 'max_overflow'),
+    ('dbpool_timeout', 'pool_timeout'),
+)
+
+
+def create_db_engine(dburi, settings, name=None):
+    """create_db_engine: create an engine of `dburi` with the pool settings of application:
+        - dbpool_size: number of connections kept in the pool;
+        - dbpool_max_overflow: number of connections can be opened beyond dbpool_size;
+        - dbpool_timeout: seconds to wait for a connection before giving up;
+        - dbpool_recycle: seconds after which a connection is recycled;
+        - dbpool_pre_ping: test connections on checkout;
+        - dblogging: echo the SQL statements.
+    A MeteredQueuePool is used when any of dbpool_size/dbpool_max_overflow/dbpool_timeout is given, otherwise the
+    default pool of the dialect. The PoolMetrics is available as `engine.pool_metrics`.
+    """
+    metrics = PoolMetrics(name=name)
+    kwargs = {'echo': settings.get('dblogging', False)}
+    pool_kwargs = dict((k, settings[s]) for s, k in POOL_SETTINGS if settings.get(s) is not None)
+    if pool_kwargs:
+        pool_kwargs['metrics'] = metrics
+        kwargs['poolclass'] = MeteredQueuePool
+        kwargs.update(pool_kwargs)
+    if settings.get('dbpool_recycle') is not None:
+        kwargs['pool_recycle'] = settings.get('dbpool_recycle')
+    engine = create_engine(dburi, **kwargs)
+    if settings.get('dbpool_pre_ping'):
+        # Listened before the metrics, a connection failed to ping is not counted as checked out.
+        event.listen(engine, 'checkout', _ping_connection_)
+    event.listen(engine, 'connect', metrics.on_connect)
+    event.listen(engine, 'checkout', metrics.on_checkout)
+    event.listen(engine, 'checkin', metrics.on_checkin)
+    engine.pool_metrics = metrics
+    return engine
+
+
+class ReplicaRouter(object):
+    """
+    ReplicaRouter: choose a replica engine for read only sessions.
+        - strategy: 'round_robin' (by default) or 'least_connections' (the one with least checked out connections);
+        - eject_seconds: seconds a replica is ejected from choosing after it failed.
+    None will be chosen when all the replicas are ejected, the caller should fall back to the primary then.
+    """
+    STRATEGIES = ('round_robin', 'least_connections')
+
+    def __init__(self, engines, strategy=None, eject_seconds=30):
+        strategy = strategy or 'round_robin'
+        assert strategy in self.STRATEGIES, 'Unknown replica strategy "%s".' % strategy
+        self.engines = list(engines)
+        self.strategy = strategy
+        self.eject_seconds = eject_seconds
+        self._ejected = dict()  # engine -> ejected until
+        self._next = 0
+
+    def healthy(self):
+        now = time.time()
+        return [e for e in self.engines if self._ejected.get(e, 0) <= now]
+
+    def choose(self):
+        engines = self.healthy()
+        if not engines:
+            return None
+        if self.strategy == 'least_connections':
+            return min(engines, key=lambda e: e.pool_metrics.checked_out)
+        self._next = (self._next + 1) % len(engines)
+        return engines[self._next]
+
+    def eject(self, engine):
+        if engine not in self.engines:
+            return
+        _logger.warning('Replica %s is ejected for %s seconds.', engine.pool_metrics.name, self.eject_seconds)
+        self._ejected[engine] = time.time() + self.eject_seconds
+
+
+class StatementCache(object):
+    """
+    StatementCache: cache of statements by the keys of query shapes, with the values of filters bound by named
+    parameters (see FilterExpression). SQLAlchemy before 1.4 compiles a statement into SQL every time it's executed,
+    unless the same statement object is executed with a `compiled_cache`. So the statements are kept by their shapes and
+    executed with the compiled cache, then the SQL is compiled once for each shape (and dialect), only the parameters
+    are bound per request.
+    SQLAlchemy 1.4+ caches the compiled SQL by itself, `enabled` is False then.
+    """
+    def __init__(self, max_size=1024):
+        self.enabled = SQLALCHEMY_VERSION < (1, 4)
+        self.statements = Memmory(max_size=max_size)
+        self.compiled = LRUCache(max_size)
+
+    def get(self, key, build):
+        """get: return the statement of `key`, `build` is called to build it when it is not cached yet."""
+        statement = self.statements.get(key)
+        if statement is None:
+            statement = build()
+            self.statements.set(key, statement)
+        return statement
+
+    def execute(self, session, mapper, key, build, params):
+        """execute: execute the statement of `key` with `params` on the connection of `session` for `mapper`."""
+        conn = session.connection(mapper=mapper).execution_options(compiled_cache=self.compiled)
+        return conn.execute(self.get(key, build), params)
+
+    def query(self, query, key, build, params):
+        """query: return `query` (of the model) loading instances from the statement of `key` with `params`."""
+        return query.from_statement(self.get(key, build)).params(params).execution_options(compiled_cache=self.compiled)
+
+
+def supports_returning(dialect, kind='update'):
+    """supports_returning: check if `dialect` supports RETURNING of multiple rows for `kind` ('update' or 'delete')
+    statements, by the flags of newer SQLAlchemy if they are available, otherwise only PostgreSQL is trusted.
+    """
+    flag = getattr(dialect, '%s_returning' % kind, None)
+    if flag is None:
+        flag = getattr(dialect, 'full_returning', None)
+    if flag is None:
+        flag = dialect.name == 'postgresql' and getattr(dialect, 'implicit_returning', False)
+    return bool(flag)
+
+
+def mark_written(session):
+    """mark_written: mark the session has something to commit, for the statements executed by session.execute()
+    directly which can not be tracked by the session events.
+    """
+    session._torexpress_written_ = True
+
+
+def _mark_written_(context, *args):
+    # The bulk events of newer SQLAlchemy pass a context which has the session instead of the session itself.
+    mark_written(getattr(context, 'session', context))
+
+
+def _clear_written_(session, *args):
+    session._torexpress_written_ = False
+
+
+def _bind_connection_(session, transaction, connection):
+    # The statements executed on this connection (and it's branches, which copy it's attributes) belong to session.
+    connection._torexpress_session_ = session
+
+
+READ_STATEMENT = re.compile(r'\s*(SELECT|EXPLAIN|SHOW|PRAGMA|DESCRIBE|VALUES)\b', re.IGNORECASE)
+
+
+def _mark_executed_(conn, cursor, statement, parameters, context, executemany):
+    # Statements executed by session.execute() directly, eg: session.execute(update(User).values(...)) or textual SQL,
+    # which are not seen by the flush and bulk events. Textual statements are taken as writes unless they read only.
+    session = getattr(conn, '_torexpress_session_', None)
+    if session is None or getattr(session, '_torexpress_written_', False):
+        return
+    if context is not None and (context.isinsert or context.isupdate or context.isdelete or context.isddl):
+        mark_written(session)
+    elif not READ_STATEMENT.match(statement):
+        mark_written(session)
+
+
+event.listen(Session, 'after_begin', _bind_connection_)
+event.listen(Engine, 'after_cursor_execute', _mark_executed_)
+event.listen(Session, 'after_flush', _mark_written_)
+event.listen(Session, 'after_bulk_update', _mark_written_)
+event.listen(Session, 'after_bulk_delete', _mark_written_)
+event.listen(Session, 'after_commit', _clear_written_)
+event.listen(Session, 'after_rollback', _clear_written_)
+
+
+def session_has_writes(session):
+    """session_has_writes: check if the session has anything to commit, either pending changes of instances or the
+    changes flushed, bulk updated/deleted or executed as DML statements in it's current transaction.
+    """
+    return bool(session.new or session.dirty or session.deleted or getattr(session, '_torexpress_written_', False))
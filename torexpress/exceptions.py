@@ -44,4 +44,9 @@ class InvalidExpression(ExpressError):
 
 class InvalidData(ExpressError):
     _error_ = 400
-    _message_ = 'Invalid Data.'
\ No newline at end of file
+    _message_ = 'Invalid Data.'
+
+
+class TooManyRecords(ExpressError):
+    _error_ = 400
+    _message_ = 'Too many records affected.'
\ No newline at end of file
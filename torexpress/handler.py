@@ -1,25 +1,41 @@
 import re
 import sys
+import hashlib
 import types
 import logging
+import itertools
+import functools
 import traceback
+from collections import OrderedDict
 from sqlalchemy.orm.query import Query
 from sqlalchemy import Column, Integer, SmallInteger, BigInteger
 from sqlalchemy import String, Unicode
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import and_, or_, func, asc, desc
+from sqlalchemy import and_, or_, func, asc, desc, tuple_, select, bindparam
 from sqlalchemy.orm import joinedload, subqueryload
+try:
+    from sqlalchemy.orm import selectinload
+except:
+    selectinload = None
 from sqlalchemy.sql import expression
+from sqlalchemy.exc import DBAPIError, OperationalError
 from tornado.web import RequestHandler, HTTPError
 from tornado import escape
+from tornado import gen
 from tornado import httputil
+from tornado.concurrent import Future
 from tornado.log import access_log, app_log, gen_log
 #from tornado.escape import utf8, _unicode
 #from tornado.util import bytes_type, unicode_type
 from . import exceptions
-from .helpers import simple_field_processor
-from .serializers import serialize, serialize_query, serialize_object, ExtJsonEncoder
+from .helpers import simple_field_processor, encode_cursor, decode_cursor, model_info
+from .cache import Memmory, get_generation, bump_generation
+from .serializers import serialize, serialize_query, serialize_object, serialize_projection, StreamedRecords
+from .serializers import get_serialize_plan
+from .database import session_has_writes, mark_written, supports_returning
+from .codec import default_json_codec, binary_codecs, binary_codec_for, BINARY_CODECS
 from .route import route2handler
+from .timing import SpanRecorder, null_recorder
 try:
     import simplejson as json
 except:
@@ -28,19 +44,9 @@ try:
     import yaml
 except:
     yaml = None
-json._default_encoder = ExtJsonEncoder()
 _logger = logging.getLogger('tornado.torexpress')
 
 
-def log_timing(tm=None, msg=None):
-    import datetime
-    msg = ('<%s>: ' % msg) or ''
-    tnew = datetime.datetime.now()
-    tused = '' if not tm else ' (%s)' % (tnew-tm)
-    _logger.info('%s%s%s', msg, tnew, tused)
-    return tnew
-
-
 def encoder(*fields):
     """Decorator for Handler function which will register the decorated function as the encoder of field(s).
     eg:
@@ -127,34 +133,278 @@ def generator(*fields):
     return wrap
 
 
+def in_executor(view):
+    """Decorator for Handler function which does the database works, the function will be run on the db_executor of
+    application (when it has one) instead of the IOLoop thread, and the session will be committed there too.
+    It should be decorated by request_handler, and should not write to the response by itself. (StreamedRecords in
+    the result are fetched chunk by chunk on the executor as well while the response is written.)
+    eg:
+    class UserHandler(RestletHandler):
+        ...
+        @route2handler(r'/stats', 'GET')
+        @request_handler
+        @in_executor
+        def stats(self, *args, **kwargs):
+            return {'count': self.db_session.query(User).count()}
+    """
+    view.__in_executor__ = True
+    return view
+
+
 def request_handler(view):
     """Decorator request_handler decorates a method of RestletHandler.
     Decorator will dumps the return value of method into JSON or YAML according to the request.
+    If the method is decorated by in_executor and the application has a db_executor, the method and the commit of
+    session run on the executor, the decorated method returns a Future which is resolved after the output is written.
     """
     def f(self, *args, **kwargs):
         _logger.debug('Headers: %s', self.request.headers)
-        t1 = log_timing(msg='1>%s Start' % view.__name__)
+        executor = getattr(self.application, 'db_executor', None) if getattr(view, '__in_executor__', False) else None
+        if executor is not None:
+            return _execute_in_executor(self, executor, view, *args, **kwargs)
         result = view(self, *args, **kwargs)
-        t2 = log_timing(tm=t1, msg='2>%s Done' % view.__name__)
-        if isinstance(result, (dict, list, tuple, types.GeneratorType)):
-            if isinstance(result, types.GeneratorType):
-                result = list(result)
-            if 'yaml' in self.request.query:
-                self.set_header('Content-Type', 'application/x-yaml')
-                result = yaml.dump(result)
-            else:
-                self.set_header('Content-Type', 'application/json')
-                result = json.dumps(result)
-            self.write(result)
-        elif isinstance(result, (str, unicode, bytearray)):
-            self.write(result)
-        else:
-            _logger.info('Result type is: %s', type(result))
-            raise exceptions.ExpressError()
-        log_timing(tm=t2, msg='3>Write output done!')
+        return write_result(self, view, result)
     return f
 
 
+@gen.coroutine
+def _execute_in_executor(handler, executor, view, *args, **kwargs):
+    # The session is committed, rolled back and closed on the executor too, so neither the commit nor the check-in of
+    # connection (with the reset of it by the pool) runs on the IOLoop thread. Sessions of lazy results (eg:
+    # StreamedRecords) are released after the writer of chunks completes.
+    def work():
+        try:
+            result = view(handler, *args, **kwargs)
+            sess = getattr(handler, '_db_session_', None)  # Do not create a session only for committing.
+            if sess is not None and session_has_writes(sess):
+                with handler.timing.span('commit'):
+                    sess.commit()
+        except Exception, e:
+            handler._release_db_session(error=e)
+            raise
+        if not is_lazy_result(result):
+            handler._release_db_session()
+        return result
+
+    result = yield executor.submit(work)
+    try:
+        future = write_result(handler, view, result)
+        if future is not None:
+            yield future
+    except Exception, e:
+        exc_info = sys.exc_info()
+        if getattr(handler, '_db_session_', None) is not None:
+            yield executor.submit(handler._release_db_session, e)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    if getattr(handler, '_db_session_', None) is not None:
+        yield executor.submit(handler._release_db_session)
+
+
+def is_lazy_result(result):
+    """is_lazy_result: check if the records of result are read from the session while they are written."""
+    return isinstance(result, types.GeneratorType) or \
+        (isinstance(result, dict) and any(isinstance(v, StreamedRecords) for v in result.values()))
+
+
+def write_result(handler, view, result):
+    """write_result: write the result returned by the method `view` to the response of handler.
+    Results written in chunks (see write_streaming and write_ndjson) return a Future which is resolved after the last
+    chunk is flushed, the others are written at once and None is returned.
+    """
+    output = output_format(handler)
+    if output == 'ndjson' and isinstance(result, (dict, list, tuple, types.GeneratorType)):
+        return _write_chunked_(handler, write_ndjson, result)
+    elif output == 'json' and isinstance(result, dict) and \
+            any(isinstance(v, StreamedRecords) for v in result.values()):
+        return _write_chunked_(handler, write_streaming, result)
+    with handler.timing.span('encode'):
+        _write_result_(handler, result)
+    _count_rows_(handler, result)
+
+
+@gen.coroutine
+def _write_chunked_(handler, writer, result):
+    yield writer(handler, result)
+    _count_rows_(handler, result)
+
+
+def _count_rows_(handler, result):
+    rows = result_rows(result)
+    if rows is not None:  # Responses from cache are encoded already, their rows are counted in ExpressHandler.get().
+        handler._rows_ = rows
+
+
+def result_rows(result):
+    """result_rows: number of records in the result of a request, for the metrics of application. StreamedRecords are
+    counted after they are written.
+    """
+    if not isinstance(result, dict):
+        return len(result) if isinstance(result, (list, tuple)) else None
+    for v in result.values():
+        if isinstance(v, StreamedRecords):
+            return v.count
+    if '__count' in result:
+        return result['__count']
+    if isinstance(result.get(result.get('__model')), dict):
+        return 1
+    return None
+
+
+def _write_result_(handler, result):
+    if isinstance(result, (dict, list, tuple, types.GeneratorType)):
+        content_type, result = encode_output(handler, result)
+        handler.set_header('Content-Type', content_type)
+        handler.write(result)
+    elif isinstance(result, (str, unicode, bytearray)):
+        handler.write(result)
+    else:
+        _logger.info('Result type is: %s', type(result))
+        raise exceptions.ExpressError()
+
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+# Query flags of output_format, they are not filters. All the binary codecs are listed, installed or not.
+OUTPUT_FLAGS = ('yaml', 'ndjson') + tuple(c.name for c in BINARY_CODECS)
+
+
+def output_format(handler):
+    """output_format: negotiate the format of output, it's shared by request_handler and write_error.
+    The query controls take precedence: `yaml`, `ndjson` (JSON Lines) or the name of an installed binary codec
+    (`msgpack`, `cbor`); then the Accept header: application/x-ndjson or the content types of binary codecs; otherwise
+    'json'.
+    """
+    query = handler.request.query
+    if 'yaml' in query:
+        return 'yaml'
+    if 'ndjson' in query:
+        return 'ndjson'
+    for name in binary_codecs:
+        if name in query:
+            return name
+    accept = handler.request.headers.get('Accept', '')
+    if accept:
+        if NDJSON_CONTENT_TYPE in accept:
+            return 'ndjson'
+        for name, codec in binary_codecs.items():
+            if any(ct in accept for ct in codec.content_types):
+                return name
+    return 'json'
+
+
+def encode_output(handler, result):
+    """encode_output: encode the result of a request into the format negotiated by output_format.
+    Returns a tuple of (content_type, encoded_output).
+    """
+    if isinstance(result, types.GeneratorType):
+        result = list(result)
+    if isinstance(result, dict):
+        for k, v in result.items():
+            if isinstance(v, StreamedRecords):
+                result[k] = list(v)
+                result.update(v.tail())
+    output = output_format(handler)
+    if output == 'yaml':
+        return 'application/x-yaml', yaml.dump(result)
+    elif output in binary_codecs:
+        return binary_codecs[output].content_type, binary_codecs[output].dumps(result)
+    elif output == 'ndjson':
+        records = result.get(result['__model']) if isinstance(result, dict) and '__model' in result else result
+        if isinstance(records, dict):
+            records = [records]
+        return NDJSON_CONTENT_TYPE, ''.join('%s\n' % handler.json_codec.dumps(r) for r in records)
+    else:
+        return handler.json_codec.content_type, handler.json_codec.dumps(result)
+
+
+def flush_and_wait(handler):
+    """flush_and_wait: flush the output of handler, returns a Future which is resolved with True after the data are
+    written to the socket, or with False once the connection is closed (see ExpressHandler.on_connection_close). The
+    writers of chunks wait for it, so no more than one chunk is buffered however slow the client is.
+    """
+    future = Future()
+    connection = handler.request.connection
+    if handler.request.method == 'HEAD':
+        handler.flush()
+        future.set_result(True)
+    elif getattr(connection, 'stream', None) is not None and connection.stream.closed():
+        future.set_result(False)
+    else:
+        handler._flush_future_ = future
+        handler.flush(callback=lambda: future.done() or future.set_result(True))
+    return future
+
+
+def encode_chunk(handler, records, chunk_size, dumps):
+    """encode_chunk: fetch and encode the next `chunk_size` records from the iterator `records`, an empty list is
+    returned at the end. The writers of chunks run it on the db_executor of application when it has one, so the cursor
+    is not read on the IOLoop thread.
+    """
+    with handler.timing.span('encode'):
+        return [dumps(r) for r in itertools.islice(records, chunk_size)]
+
+
+@gen.coroutine
+def write_streaming(handler, result, chunk_size=100):
+    """write_streaming: write the result which contains StreamedRecords as JSON in chunks, records are fetched,
+    encoded and flushed every `chunk_size` rows, the other keys of envelope are written around the streamed array.
+    The next chunk is not fetched until the last one is written to the socket, so the memory stays flat no matter how
+    many rows are returned or how slow the client is. Writing stops when the connection is closed.
+    """
+    executor = getattr(handler.application, 'db_executor', None)
+    dumps = handler.json_codec.dumps
+    handler.set_header('Content-Type', handler.json_codec.content_type)
+    streams = list()
+    heads = list()
+    for k, v in result.items():
+        if isinstance(v, StreamedRecords):
+            streams.append((k, v))
+        else:
+            heads.append('%s:%s' % (dumps(k), dumps(v)))
+    handler.write('{' + ','.join(heads))
+    tails = dict()
+    for i, (k, records) in enumerate(streams):
+        handler.write('%s%s:[' % (',' if heads or i else '', dumps(k)))
+        sep = ''
+        encode = functools.partial(encode_chunk, handler, iter(records), chunk_size, dumps)
+        while True:
+            chunk = (yield executor.submit(encode)) if executor is not None else encode()
+            if not chunk:
+                break
+            handler.write(sep + ','.join(chunk))
+            sep = ','
+            if not (yield flush_and_wait(handler)):
+                return
+        handler.write(']')
+        tails.update(records.tail())
+    for k, v in tails.items():
+        handler.write(',%s:%s' % (dumps(k), dumps(v)))
+    handler.write('}')
+
+
+@gen.coroutine
+def write_ndjson(handler, result, chunk_size=100):
+    """write_ndjson: write the records of result as JSON Lines, one record per line without the envelope. Records are
+    written straight from the query cursor when they are StreamedRecords, and flushed every `chunk_size` lines in the
+    same way as write_streaming.
+    """
+    executor = getattr(handler.application, 'db_executor', None)
+    dumps = handler.json_codec.dumps
+    handler.set_header('Content-Type', NDJSON_CONTENT_TYPE)
+    records = result.get(result['__model']) if isinstance(result, dict) and '__model' in result else result
+    if isinstance(records, dict):
+        records = [records]
+    if not isinstance(records, StreamedRecords):
+        executor = None  # Records are in memory already.
+    encode = functools.partial(encode_chunk, handler, iter(records), chunk_size, dumps)
+    while True:
+        chunk = (yield executor.submit(encode)) if executor is not None else encode()
+        if not chunk:
+            break
+        handler.write('\n'.join(chunk) + '\n')
+        if not (yield flush_and_wait(handler)):
+            return
+
+
 class URLSpec(object):
     """Specifies mappings between URLs and handlers."""
     def __init__(self, pattern, request_handler, methods=None, kwargs=None):
@@ -185,6 +435,7 @@ class URLSpec(object):
         self.request_handler = request_handler
         self.kwargs = kwargs or {}
         self.methods = methods
+        self.allowed_methods = frozenset(methods) if methods else None
         self._path, self._group_count = self._find_groups()
 
     def __repr__(self):
@@ -220,6 +471,59 @@ class URLSpec(object):
         return ''.join(pieces), self.regex.groups
 
 
+ROUTE_REGEX_SPECIALS = frozenset('.^$*+?{}[]\\|()')
+
+
+def literal_first_segment(pattern):
+    """literal_first_segment: return the literal first path segment of a route pattern, eg: 'login' for r'login/(.*)$'.
+    None will be returned when the first segment is not a plain literal (contains any regex syntax), the route can not
+    be indexed then.
+    """
+    if '|' in pattern:
+        return None
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    for i, c in enumerate(pattern):
+        if c == '/' or (c == '$' and i == len(pattern) - 1):
+            return pattern[:i]
+        if c in ROUTE_REGEX_SPECIALS:
+            return None
+    return pattern
+
+
+class RouteDispatcher(object):
+    """RouteDispatcher: the compiled dispatch table of a handler's routes and pk_spec.
+    Routes are indexed by the literal first segment of their patterns, so matching a path only tries the routes
+    sharing it's first segment plus the ones can not be indexed, in the order they were declared; pk_spec is the last
+    one to try.
+    """
+    def __init__(self, specs, pk_spec=None):
+        self.pk_spec = pk_spec
+        indexed = dict()
+        self._unindexed = list()
+        for i, spec in enumerate(specs):
+            segment = literal_first_segment(spec.regex.pattern)
+            if segment is None:
+                self._unindexed.append((i, spec))
+            else:
+                indexed.setdefault(segment, list()).append((i, spec))
+        self._candidates = dict((segment, [x[1] for x in sorted(v + self._unindexed)])
+                                for segment, v in indexed.items())
+        self._unindexed = [x[1] for x in self._unindexed]
+
+    def match(self, path):
+        """match: return (spec, match) of the first route matches `path`, or (pk_spec, match), or (None, None)."""
+        for spec in self._candidates.get(path.split('/', 1)[0], self._unindexed):
+            match = spec.regex.match(path)
+            if match:
+                return spec, match
+        if self.pk_spec is not None:
+            match = self.pk_spec.regex.match(path)
+            if match:
+                return self.pk_spec, match
+        return None, None
+
+
 def revert_list_of_qs(qs):
     """revert_list_of_qs, process the result of escape.parse_qs_bytes which convert the item values if the type is list
     and has only one element to it's first element. Otherwize, keep the original value.
@@ -265,6 +569,53 @@ def str2list(s):
         return s.split(',')
 
 
+def _pk_normalizer_(column):
+    """_pk_normalizer_: create a function converts a pk value from payload for looking up the objects of `column`,
+    returns None for the values can not be converted or hashed.
+    """
+    pf = simple_field_processor(column)
+
+    def normalize(v):
+        try:
+            v = pf(v) if pf else v
+            hash(v)
+            return v
+        except (TypeError, ValueError):
+            return None
+
+    return normalize
+
+
+def _pk_key_(column, dialect):
+    """_pk_key_: create a function converts a pk value of `column` into the key for looking up the loaded objects, it's
+    the value processed by the bind processor of column type as the database compares it, so a pk from payload (eg: an
+    uuid string) finds the object loaded with the pk of another python type (eg: UUID).
+    Returns None for the values can not be converted or hashed.
+    """
+    normalize = _pk_normalizer_(column)
+    bp = column.type.bind_processor(dialect)
+
+    def key(v):
+        v = normalize(v)
+        if v is None or bp is None:
+            return v
+        try:
+            v = bp(v)
+            hash(v)
+            return v
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+    return key
+
+
+def str2bool(s):
+    """str2bool: a flag in url query is True when it's present with a blank value or any value except 0/false/no."""
+    if s is None:
+        return False
+    return s.lower() not in ('0', 'false', 'no')
+
+
 def str2int(s):
     if s is None:
         return None
@@ -276,97 +627,128 @@ QUERY_LOOKUPS = ('not', 'contains', 'startswith', 'endswith', 'in', 'range', 'lt
                  'year', 'month', 'day', 'hour', 'minute', 'dow', '')
 
 
-def build_filter(model, key, value, joins=None):
-    _logger.debug('build_filter>>> %s | %s | %s | %s', model, key, value, joins)
-    if not key:
-        raise exceptions.InvalidExpression(message='Invalid Expression!')  # return None, None
-
-    def _encode_(k, v):
-        f = model.__handler__._get_encoder(k) if hasattr(model, '__handler__') else None
-        if f is None:
-            return v
-        else:
-            return f(v)
-
-    k1 = key.pop(0)  # Get the first part of key
-    kk = k1.split('__')
-    kk1 = kk.pop(0)
-    if kk1 in model.__table__.c.keys():  # Check if this is a field
-        field = getattr(model, kk1)
-        if not kk:
-            return field == _encode_(kk1, value), joins
+EXTRACT_LOOKUPS = ('year', 'month', 'day', 'hour', 'minute', 'dow')
+EXTRACT_OPERATORS = ('', 'lt', 'lte', 'gt', 'gte', 'in', 'range')
+LIST_OPERATORS = ('in', 'range')
+LIKE_PATTERNS = {'contains': u'%%%s%%', 'startswith': u'%s%%', 'endswith': u'%%%s'}
+FILTER_OPERATORS = {
+    '': lambda f, v: f == v,
+    'contains': lambda f, v: f.like(v),
+    'startswith': lambda f, v: f.like(v),
+    'endswith': lambda f, v: f.like(v),
+    'in': lambda f, v: f.in_(v),
+    'range': lambda f, v: and_(f >= v[0], f <= v[1]),
+    'lt': lambda f, v: f < v,
+    'lte': lambda f, v: f <= v,
+    'gt': lambda f, v: f > v,
+    'gte': lambda f, v: f >= v,
+}
+
+
+class FilterExpression(object):
+    """FilterExpression: the compiled shape of a filter key, eg: 'group.created__year__gte', with the target field (a
+    column or an EXTRACT of it), the relationships to join, the operator, the negation and the converter of values
+    (encoder of the column, or int for EXTRACT). Calling it with a value builds the criteria, only the value is bound
+    per request.
+    """
+    __slots__ = ('field', 'joins', 'op', 'negate', 'convert')
+
+    def __init__(self, field, joins, op, negate, convert):
+        self.field = field
+        self.joins = joins
+        self.op = op
+        self.negate = negate
+        self.convert = convert
+
+    def __call__(self, value, name=None, params=None):
+        """Build the criteria with `value`. When a dictionary `params` is given, the value is bound by a parameter named
+        `name` (or `name`_0, `name`_1, ... for the list operators) which is collected into `params`, instead of being
+        embedded in the criteria, so the statement is the same for all the values of the shape.
+        """
+        if self.op in LIST_OPERATORS:
+            value = [self.convert(x) for x in (value if isinstance(value, (list, tuple)) else str2list(value))]
+            if self.op == 'range' and len(value) != 2:
+                raise exceptions.InvalidExpression(message='Invalid Expression!')
+        elif self.op in LIKE_PATTERNS:
+            value = LIKE_PATTERNS[self.op] % self.convert(value)
         else:
-            _not_ = False
-            if 'not' in kk:
-                _not_ = True
-                kk.remove('not')
-            if not kk:
-                return (~(field == _encode_(kk1, value)) if _not_ else (field == _encode_(kk1, value))), joins
-            op = kk.pop(0)
-            if 'contains' == op and not kk:
-                exp = field.like(u'%%%s%%' % _encode_(kk1, value))
-            elif 'startswith' == op and not kk:
-                exp = field.like(u'%s%%' % _encode_(kk1, value))
-            elif 'endswith' == op and not kk:
-                exp = field.like(u'%%%s' % _encode_(kk1, value))
-            elif 'in' == op and not kk:
-                exp = field.in_(map(lambda x: _encode_(kk1, x),
-                                    value if isinstance(value, (list, tuple)) else str2list(value)))
-            elif 'range' == op and not kk:
-                value = map(lambda x: _encode_(kk1, x), value if isinstance(value, (list, tuple)) else str2list(value))
-                if len(value) != 2:
-                    raise exceptions.InvalidExpression(message='Invalid Expression!')  # return None, None
-                exp = and_(field >= _encode_(kk1, value[0]), field <= _encode_(kk1, value[1]))
-            elif 'lt' == op and not kk:
-                exp = field < _encode_(kk1, value)
-            elif 'lte' == op and not kk:
-                exp = field <= _encode_(kk1, value)
-            elif 'gt' == op and not kk:
-                exp = field > _encode_(kk1, value)
-            elif 'gte' == op and not kk:
-                exp = field >= _encode_(kk1, value)
-            elif op in ('year', 'month', 'day', 'hour', 'minute', 'dow'):
-                # This needs the RMDBs support the EXTRACT function for DATETIME field.
-                if not kk:
-                    exp = expression.extract(op.upper(), field) == int(value)
-                elif len(kk) == 1:
-                    exop = kk[0]
-                    if exop == 'lt':
-                        exp = expression.extract(op.upper(), field) < int(value)
-                    elif exop == 'lte':
-                        exp = expression.extract(op.upper(), field) <= int(value)
-                    elif exop == 'gt':
-                        exp = expression.extract(op.upper(), field) > int(value)
-                    elif exop == 'gte':
-                        exp = expression.extract(op.upper(), field) >= int(value)
-                    elif exop == 'in':
-                        exp = expression.extract(op.upper(), field).in_(map(lambda x:int(x),
-                                                                            value if isinstance(value, (list, tuple))
-                                                                            else str2list(value)))
-                    elif exop == 'range':
-                        value = map(lambda x: int(x), value if isinstance(value, (list, tuple)) else str2list(value))
-                        if len(value) != 2:
-                            raise exceptions.InvalidExpression(message='Invalid Expression!')  # return None, None
-                        exp = and_(expression.extract(op.upper(), field) >= int(value[0]),
-                                   expression.extract(op.upper(), field) <= int(value[1]))
-                    else:
-                        raise exceptions.InvalidExpression(message='Invalid Expression!')  # return None, None
-                else:
-                    raise exceptions.InvalidExpression(message='Invalid Expression!')  # return None, None
-
+            value = self.convert(value)
+        if params is not None:
+            if self.op in LIST_OPERATORS:
+                names = ['%s_%d' % (name, i) for i in range(len(value))]
+                params.update(zip(names, value))
+                value = [bindparam(n) for n in names]
             else:
-                raise exceptions.InvalidExpression(message='Invalid Expression!')  # return None, None
-            return ~exp if _not_ else exp, joins
-    elif k1 in model.__mapper__.relationships.keys() and key:  # Check if this is a relationship
-        _logger.debug('go relationships: %s, %s', k1, joins)
-        relationship = getattr(model, k1)
-        if joins:
-            joins.append(relationship)
+                params[name] = value
+                value = bindparam(name)
+        exp = FILTER_OPERATORS[self.op](self.field, value)
+        return ~exp if self.negate else exp
+
+
+def _compile_filter_(model, parts):
+    parts = list(parts)
+    joins = list()
+    while True:
+        info = model_info(model)
+        k1 = parts.pop(0)  # Get the first part of key
+        kk = k1.split('__')
+        kk1 = kk.pop(0)
+        if kk1 in info.columns:  # Check if this is a field
+            break
+        elif k1 in info.relationships and parts:  # Check if this is a relationship
+            joins.append(getattr(model, k1))
+            model = info.targets[k1]
         else:
-            joins = [relationship]
-        return build_filter(model.__mapper__.relationships[k1].mapper.class_, key, value, joins=joins)
-    else:  # Check of this is
+            return False
+    field = getattr(model, kk1)
+    negate = 'not' in kk
+    if negate:
+        kk.remove('not')
+    op = kk.pop(0) if kk else ''
+    if op in EXTRACT_LOOKUPS:
+        # This needs the RMDBs support the EXTRACT function for DATETIME field.
+        exop = kk.pop(0) if kk else ''
+        if kk or exop not in EXTRACT_OPERATORS:
+            raise exceptions.InvalidExpression(message='Invalid Expression!')
+        return FilterExpression(expression.extract(op.upper(), field), tuple(joins), exop, negate, int)
+    if kk or op not in FILTER_OPERATORS:
+        raise exceptions.InvalidExpression(message='Invalid Expression!')
+    return FilterExpression(field, tuple(joins), op, negate, info.encoders.get(kk1) or (lambda v: v))
+
+
+_compiled_filters_ = Memmory(max_size=4096)
+
+
+def compile_filter(model, key):
+    """compile_filter: compile the filter key `key` of `model` (a string like 'group.name__startswith' or a list of
+    it's parts split by '.') into a FilterExpression. The result is cached by (model, key), so the parsing of key,
+    the descent of relationships and the lookup of operator and encoder are done once for each shape of filter.
+    Returns None when the key is not a filter of model (neither a column nor a relationship), InvalidExpression is
+    raised for invalid operators.
+    """
+    parts = tuple(key.split('.')) if isinstance(key, basestring) else tuple(key)
+    cache_key = (model, parts)
+    compiled = _compiled_filters_.get(cache_key)
+    if compiled is None:
+        compiled = _compile_filter_(model, parts)
+        _compiled_filters_.set(cache_key, compiled)
+    return compiled or None
+
+
+def build_filter(model, key, value, joins=None, name=None, params=None):
+    """build_filter: build the criteria of filter `key` with `value` by the compiled FilterExpression, the value is
+    bound by parameter `name` collected into `params` when it's given.
+    Returns a tuple of (criteria, joins), (None, None) if the key is not a filter of model.
+    """
+    _logger.debug('build_filter>>> %s | %s | %s | %s', model, key, value, joins)
+    if not key:
+        raise exceptions.InvalidExpression(message='Invalid Expression!')  # return None, None
+    compiled = compile_filter(model, key)
+    if compiled is None:
         return None, None
+    if compiled.joins:
+        joins = list(joins or []) + list(compiled.joins)
+    return compiled(value, name=name, params=params), joins
 
 
 def build_order_by(cls, order_by):
@@ -376,7 +758,7 @@ def build_order_by(cls, order_by):
         if by and by.startswith('-'):
             by = by[1:]
             is_desc = True
-        if by and by in c.__table__.c.keys():
+        if by and by in model_info(c).columns:
             return None, desc(getattr(c, by)) if is_desc else asc(getattr(c, by))
         else:
             return None, None
@@ -395,36 +777,209 @@ def build_order_by(cls, order_by):
     return joins, order_bys
 
 
+def build_keyset(cls, order_by):
+    """build_keyset: build the keys of keyset pagination with the given list order_by in strings.
+    Returns a list of (column, is_desc), the primary key columns are always appended as the tie breaker so the keys
+    are unique for each row.
+    """
+    info = model_info(cls)
+    keys = list()
+    names = set()
+    for by in (order_by or []):
+        is_desc = by.startswith('-')
+        by = by[1:] if is_desc else by
+        if by and by in info.columns and by not in names:
+            keys.append((getattr(cls, by), is_desc))
+            names.add(by)
+    for by in info.pk_names:
+        if by not in names:
+            keys.append((getattr(cls, by), keys[-1][1] if keys else False))
+            names.add(by)
+    return keys
+
+
+def keyset_filter(keys, values, dialect_name=None):
+    """keyset_filter: build the criteria selecting the rows after the row with sort key `values`.
+    A row value comparison `(c1, c2, ...) > (v1, v2, ...)` is used when all keys are in the same direction, so the
+    database can walk the index of keys directly. Otherwise (or on SQLite which may not support row values), it will be
+    expanded into `c1 > v1 OR (c1 = v1 AND c2 > v2) OR ...`.
+    """
+    if len(values) != len(keys):
+        raise exceptions.InvalidExpression(message='Invalid cursor!')
+    directions = set(d for c, d in keys)
+    if len(directions) == 1 and dialect_name != 'sqlite':
+        columns, values = tuple_(*[c for c, d in keys]), tuple_(*values)
+        return columns < values if directions.pop() else columns > values
+    criterias = list()
+    for i, (c, d) in enumerate(keys):
+        exps = [keys[j][0] == values[j] for j in range(i)]
+        exps.append(c < values[i] if d else c > values[i])
+        criterias.append(and_(*exps))
+    return or_(*criterias)
+
+
+def pk_chunks(query, pk_columns, chunk_size=1000):
+    """pk_chunks: iterate the pks (tuples) of records matched by `query` in lists of `chunk_size`, walking the index of
+    primary key with keyset pagination, so only one chunk is held at a time and no OFFSET is scanned.
+    """
+    keys = [(c, False) for c in pk_columns]
+    dialect_name = query_dialect(query).name
+    query = query.with_entities(*pk_columns).distinct().order_by(*pk_columns)
+    last = None
+    while True:
+        q = query.filter(keyset_filter(keys, last, dialect_name)) if last else query
+        chunk = [tuple(r) for r in q.limit(chunk_size)]
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last = chunk[-1]
+
+
+def pk_criteria(pk_columns, pks):
+    """pk_criteria: build the criteria of primary key `pk_columns` in `pks`, which is either a list of tuples (from
+    pk_chunks) or a select of the pk columns.
+    """
+    if isinstance(pks, (list, tuple)):
+        if len(pk_columns) == 1:
+            return pk_columns[0].in_([x[0] for x in pks])
+        return or_(*[and_(*[c == v for c, v in zip(pk_columns, x)]) for x in pks])
+    if len(pk_columns) == 1:
+        return pk_columns[0].in_(pks)
+    return tuple_(*pk_columns).in_(pks)
+
+
 def find_join_loads(cls, extend_fields):
     """find_join_loads: find the relationships from extend_fields which we can call joinloads for EagerLoad..."""
     def _relations_(c, exts):
         if not exts:
             return None
-        tt1 = log_timing(msg='_relations_:1')
         ret = list()
         r = exts.pop(0)
-        keys = c.__mapper__.relationships.keys()
-        tt2 = log_timing(tm=tt1, msg='_relations_:2')
-        if r in keys:
+        info = model_info(c)
+        if r in info.relationships:
             ret.append(r)
-            r1 = _relations_(c.__mapper__.relationships[r].mapper.class_, exts)
+            r1 = _relations_(info.targets[r], exts)
             if r1:
                 ret.extend(r1)
         return ret
 
     if not extend_fields:
         return None
-    _logger.info('extend_fields> %s', extend_fields)
-    t1 = log_timing(msg='find_join_loads:1')
+    _logger.debug('extend_fields> %s', extend_fields)
     result = list()
     for x in extend_fields:
         y = _relations_(cls, x.split('.'))
         if y:
             result.append('.'.join(y))
-    t2 = log_timing(tm=t1, msg='find_join_loads:2')
     return result
 
 
+LOADERS = {
+    'joined': joinedload,
+    'subquery': subqueryload,
+    'selectin': selectinload or subqueryload,  # selectinload is only available in SQLAlchemy 1.2+.
+}
+
+
+def build_loaders(cls, join_loads, strategies=None):
+    """build_loaders: build the loader options of the relationship paths `join_loads` (from find_join_loads), with the
+    strategy chosen by the direction of each relationship:
+        - many-to-one (or one-to-one): joinedload, it adds columns but never adds rows;
+        - one-to-many and many-to-many: selectinload (subqueryload before SQLAlchemy 1.2), the collections are loaded
+          by a second query for the parent rows after LIMIT/OFFSET, so count and pagination work on the parent rows
+          and the joined rows never multiply them.
+    `strategies` is a dictionary of path to 'joined', 'subquery' or 'selectin' to override the default (Meta.loaders),
+    eg: {'users': 'joined', 'users.permissions': 'subquery'}
+    """
+    strategies = strategies or {}
+    options, seen = list(), set()
+    for path in (join_loads or []):
+        c, names = cls, path.split('.')
+        for i, name in enumerate(names):
+            info = model_info(c)
+            c = info.targets[name]
+            p = '.'.join(names[:i + 1])
+            if p in seen:
+                continue
+            seen.add(p)
+            strategy = strategies.get(p) or ('selectin' if name in info.collections else 'joined')
+            if strategy not in LOADERS:
+                raise Exception('Unknown loader strategy "%s" of "%s".' % (strategy, p))
+            options.append(LOADERS[strategy](p))
+    return options
+
+
+def make_cache_key(handler, pk, controls, query):
+    """make_cache_key: build the response cache key of a GET request from the handler, the pk and the canonicalized
+    controls and query returned by query_reparse. The output format negotiated by output_format, headers listed in
+    Meta.cache_vary and the generations of tables the handler depends on are part of the key, so the key changes once
+    any of those tables is written.
+    """
+    def _canonical_(v):
+        if isinstance(v, dict):
+            return tuple(sorted((k, _canonical_(x)) for k, x in v.items()))
+        elif isinstance(v, (list, tuple)):
+            return tuple(_canonical_(x) for x in v)
+        return v
+
+    cache = handler.application.cache
+    meta = handler._meta
+    parts = (
+        handler.__class__.__module__, handler.__class__.__name__, pk,
+        _canonical_(controls), _canonical_(query), output_format(handler),
+        tuple(handler.request.headers.get(h) for h in (meta.cache_vary or ())),
+        tuple(get_generation(cache, t) for t in handler._cache_tables()),
+    )
+    return 'torexpress:response:%s' % hashlib.md5(repr(parts)).hexdigest()
+
+
+TOTAL_MODES = ('exact', 'estimate', 'none')
+
+
+def query_dialect(query):
+    """query_dialect: return the dialect of database which the query will be executed on."""
+    return query.session.get_bind(query._mapper_zero()).dialect
+
+
+def estimate_count(query):
+    """estimate_count: return the number of rows of query estimated by the database planner, which is much cheaper
+    than a SELECT count(*) on large tables. Only PostgreSQL supports it for now, the other dialects (eg: SQLite which
+    does not expose any row estimate) fall back to an exact count.
+    """
+    dialect = query_dialect(query)
+    if dialect.name != 'postgresql':
+        return query.count()
+    statement = query.statement.compile(dialect=dialect)
+    plan = query.session.connection(mapper=query._mapper_zero()).execute(
+        'EXPLAIN (FORMAT JSON) %s' % statement, statement.params).scalar()
+    if isinstance(plan, (str, unicode)):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def exists_criteria(joins, criteria):
+    """exists_criteria: wrap `criteria` on the model at the end of relationship path `joins` into EXISTS subqueries,
+    by any() for collections and has() for the others, eg: User.permissions.any(Permission.name == 'admin'). So the
+    rows are filtered by semi-joins and never multiplied by the related rows.
+    """
+    for j in reversed(joins):
+        criteria = j.any(criteria) if j.property.uselist else j.has(criteria)
+    return criteria
+
+
+def query_shape(query):
+    """query_shape: the shape of query dictionary re-constructed by query_reparse, which is the groups with their
+    filter keys without values.
+    """
+    return tuple(sorted((g, tuple(sorted(c.keys()))) for g, c in (query or {}).items()))
+
+
+def count_statement(query):
+    """count_statement: build the SELECT count(*) statement of query, like Query.count() does."""
+    return select([func.count()]).select_from(query.order_by(None).statement.alias())
+
+
 def query_reparse(query):
     """query_reparse: reparse the query.
     Returns controls dictionary and re-constructed query dictionary.
@@ -432,15 +987,26 @@ def query_reparse(query):
     if not query or not isinstance(query, dict):
         return {}, {}
     new_query = {'__default': {}}
+    # Pages of keyset pagination are not counted unless `__total` is given, a walk by cursors should not count all the
+    # matched records for every page.
+    default_total = 'none' if '__after' in query else 'exact'
     controls = {
         'include_fields': str2list(query.pop('__include_fields', None)),
         'exclude_fields': str2list(query.pop('__exclude_fields', None)),
         'extend_fields': str2list(query.pop('__extend_fields', None)),
         'begin': str2int(query.pop('__begin', 0)),
         'limit': str2int(query.pop('__limit', None)),
-        'order_by': str2list(query.pop('__order_by', None))
+        'order_by': str2list(query.pop('__order_by', None)),
+        'total': query.pop('__total', None) or default_total,
+        'after': query.pop('__after', None),
+        'stream': str2bool(query.pop('__stream', None)),
     }
+    if controls['total'] not in TOTAL_MODES:
+        raise exceptions.InvalidExpression(message='Invalid __total "%s", should be one of: %s' % (
+            controls['total'], ','.join(TOTAL_MODES)))
     for k, v in query.items():
+        if k in OUTPUT_FLAGS:
+            continue  # Kept in query for output_format.
         ks = k.split('|')
         if len(ks) == 1:
             new_query['__default'][k] = v
@@ -449,6 +1015,9 @@ def query_reparse(query):
     return controls, new_query
 
 
+REPLICA_METHODS = ('GET', 'HEAD', 'OPTIONS')  # Requests of these methods read from replicas.
+
+
 class ExpressBase(type):
     """
     Metaclass for all models.
@@ -460,19 +1029,20 @@ class ExpressBase(type):
         attr_meta = attrs.pop('Meta', None)
         attr_meta = attr_meta or Meta()
         for k in ('table', 'pk_regex', 'pk_spec', 'allowed', 'denied', 'readonly', 'invisible', 'order_by',
-                  'validators', 'encoders', 'encoders', 'decoders', 'generators', 'extensible', 'routes', 'required'):
+                  'validators', 'encoders', 'encoders', 'decoders', 'generators', 'extensible', 'routes', 'required',
+                  'cache_ttl', 'cache_vary', 'replica_reads', 'bulk_create', 'bulk_pks', 'max_affected_rows',
+                  'loaders', 'exists_filters'):
             if not hasattr(attr_meta, k):
                 setattr(attr_meta, k, None)
         if attr_meta.pk_regex is None and attr_meta.table:
-            attr_meta.pk_regex = make_pk_regex(attr_meta.table.__table__.primary_key.columns.values())
+            attr_meta.pk_regex = make_pk_regex(model_info(attr_meta.table).pk_columns)
         attr_meta.pk_spec = URLSpec(attr_meta.pk_regex[1], None) if attr_meta.pk_regex else None
         attr_meta.allowed = attr_meta.allowed or ['GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS']
         if attr_meta.denied:
             attr_meta.allowed = list(set(attr_meta.allowed) - set(attr_meta.denied))
         if attr_meta.table:
-            attr_meta.readonly = list(set(attr_meta.readonly) |
-                                      set(attr_meta.table.__table__.primary_key.columns.keys())) \
-                if attr_meta.readonly else attr_meta.table.__table__.primary_key.columns.keys()
+            attr_meta.readonly = list(set(attr_meta.readonly) | set(model_info(attr_meta.table).pk_names)) \
+                if attr_meta.readonly else list(model_info(attr_meta.table).pk_names)
         attr_meta.validators = attr_meta.validators or {}
         attr_meta.encoders = attr_meta.encoders or {}
         attr_meta.decoders = attr_meta.decoders or {}
@@ -502,17 +1072,14 @@ class ExpressBase(type):
                 continue  # Ignored the base classes when it's not from ExpressBase.
             if hasattr(bcls, '_meta') and hasattr(bcls._meta, 'routes') and bcls._meta.routes:
                 attr_meta.routes.extend(bcls._meta.routes)
+        attr_meta.dispatcher = RouteDispatcher(attr_meta.routes, attr_meta.pk_spec)
         ### Only takes the required meta attribute from base class when it is not defined in this new class
         if attr_meta.required is None and bases and hasattr(bases[0], '_meta') and hasattr(bases[0]._meta, 'required'):
             attr_meta.required = bases[0]._meta.required
         if attr_meta.table:
-            for c in attr_meta.table.__mapper__.c.values():
-                if c.name in attr_meta.encoders:
-                    continue
-                pf = simple_field_processor(c)
-                if pf is None:
-                    continue
-                attr_meta.encoders[c.name] = pf
+            for field, pf in model_info(attr_meta.table).processors.items():
+                if field not in attr_meta.encoders:
+                    attr_meta.encoders[field] = pf
         new_class = super_new(cls, name, bases, attrs)
         new_class.add_to_class('_meta', attr_meta)
         if attr_meta.table is not None:
@@ -544,6 +1111,18 @@ class ExpressHandler(RequestHandler):
                 decoders = None  # User a dict or decorator @decoder(*fields)
                 generators = None  # User a dict or decorator @generator(*fields)
                 extensible = None  # None means no fields is extensible or a tuple with fields.
+                cache_ttl = None  # Seconds to cache the GET responses in application.cache, None means no caching.
+                cache_vary = None  # A tuple of request header names the cached GET responses vary on.
+                replica_reads = None  # False to keep GET/HEAD/OPTIONS requests reading from the primary.
+                bulk_create = None  # True to create list payloads in bulk mode without `__bulk` in query.
+                bulk_pks = None  # False to respond only the __count of records created in bulk mode, the rows are
+                                 # inserted by executemany without reading back the generated pks then.
+                max_affected_rows = None  # Max records can be updated/deleted by query, setting `max_affected_rows`
+                                          # of application is used when it's None.
+                loaders = None  # {'path.of.relationship': 'joined'|'subquery'|'selectin'} to override the loading
+                                # strategy of extended relationships.
+                exists_filters = None  # False to filter on collections (eg: `users.name`) by joins instead of
+                                       # EXISTS, the rows (and __total) are multiplied by the matched related rows.
 
         @encoder('password')
         def password_encoder(self, passwd, record=None):
@@ -556,6 +1135,14 @@ class ExpressHandler(RequestHandler):
         skip_request = kwargs.pop('__skip_request', False)
         default_db_session = kwargs.pop('__db_session', None)
         super(ExpressHandler, self).__init__(*args, **kwargs)
+        # Spans of the phases of request are only recorded when the application has timing sinks.
+        self.timing = SpanRecorder() if getattr(self.application, 'timing_sinks', None) and not skip_request \
+            else null_recorder
+        # Requests are labeled by the route (pattern of URLSpec) matched in _execute_method for the metrics.
+        self._metrics_ = None if skip_request else getattr(self.application, 'metrics', None)
+        self._route_ = ''
+        self._error_ = None
+        self._rows_ = None
         _logger.debug('%s [%s] > %s', self.__class__.__name__, self.request.method, self.request.uri)
         if default_db_session:
             self._db_session_ = default_db_session
@@ -565,29 +1152,38 @@ class ExpressHandler(RequestHandler):
         ## This helps to seperate the query of database and update request.
         ## It's a waiste to re-construct query and arguments here again because the httpserver has already did it, but
         ## we'll think about it later.
-        if self.request.method in ('POST', 'PUT', 'PATCH') and not skip_request:
-            content_type = self.request.headers.get('Content-Type', '')
-            self.request.arguments = {}
-            try:
-                if content_type.startswith('application/json'):
-                    # JSON
-                    self.request.arguments = json.loads(self.request.body)
-                elif content_type.startswith('application/x-yaml'):
-                    # YAML
-                    self.request.arguments = yaml.load(self.request.body)
-                else:
-                    httputil.parse_body_arguments(content_type,
-                                                  self.request.body,
-                                                  self.request.arguments,
-                                                  self.request.files)
-                    revert_list_of_qs(self.request.arguments)
-            except Exception, e:
-                _logger.warning('Decoding request body failed according to content type (%s): %s', content_type, e)
-        if self.request.query and not skip_request:
-            self.request.query = escape.parse_qs_bytes(self.request.query, keep_blank_values=True)
-            revert_list_of_qs(self.request.query)
+        with self.timing.span('parse'):
+            if self.request.method in ('POST', 'PUT', 'PATCH') and not skip_request:
+                content_type = self.request.headers.get('Content-Type', '')
+                self.request.arguments = {}
+                try:
+                    if content_type.startswith('application/json'):
+                        # JSON
+                        self.request.arguments = self.json_codec.loads(self.request.body)
+                    elif content_type.startswith('application/x-yaml'):
+                        # YAML
+                        self.request.arguments = yaml.load(self.request.body)
+                    elif binary_codec_for(content_type) is not None:
+                        # MessagePack, CBOR
+                        self.request.arguments = binary_codec_for(content_type).loads(self.request.body)
+                    else:
+                        httputil.parse_body_arguments(content_type,
+                                                      self.request.body,
+                                                      self.request.arguments,
+                                                      self.request.files)
+                        revert_list_of_qs(self.request.arguments)
+                except Exception, e:
+                    _logger.warning('Decoding request body failed according to content type (%s): %s',
+                                    content_type, e)
+            if self.request.query and not skip_request:
+                self.request.query = escape.parse_qs_bytes(self.request.query, keep_blank_values=True)
+                revert_list_of_qs(self.request.query)
 
     def _execute_required(self, method=None, *args, **kwargs):
+        with self.timing.span('auth'):
+            self._execute_required_(method, *args, **kwargs)
+
+    def _execute_required_(self, method=None, *args, **kwargs):
         _logger.debug(">>>>>_execute_required:: %s", self._meta.required)
         if method is None:
             if self._meta.required and isinstance(self._meta.required, (tuple, list)):
@@ -604,6 +1200,7 @@ class ExpressHandler(RequestHandler):
                         rfs(self, *args, **kwargs)
 
     @request_handler
+    @in_executor
     def get(self, *args, **kwargs):
         _logger.debug('[%s] GET> args(%s), kwargs(%s)', self.__class__.__name__, args, kwargs)
         _logger.debug('Request::headers> %s', self.request.headers)
@@ -612,15 +1209,32 @@ class ExpressHandler(RequestHandler):
         _logger.debug('Request::query> %s', self.request.query)
         _logger.debug('Request::arguments> %s', self.request.arguments)
         _logger.debug('self._meta.pk_regex: %s', self._meta.pk_regex)
-        t1 = log_timing(msg='GET Start')
         self._execute_required(method='get', *args, **kwargs)
-        controls, queries = query_reparse(self.request.query)
-        t2 = log_timing(tm=t1, msg='Query Parsed')
-        result = self._read(pk=kwargs.get(self._meta.pk_regex[0], None), query=queries, **controls)
-        log_timing(tm=t2, msg='Read Done')
+        pk = kwargs.get(self._meta.pk_regex[0], None)
+        with self.timing.span('parse'):
+            controls, queries = query_reparse(self.request.query)
+        if output_format(self) == 'ndjson':
+            controls['stream'] = True
+        cache_key = None
+        if self._meta.cache_ttl and not controls.get('stream') and getattr(self.application, 'cache', None) is not None:
+            cache_key = make_cache_key(self, pk, controls, queries)
+            cached = self.application.cache.get(cache_key)
+            if cached is not None:
+                content_type, output, self._rows_ = cached
+                self.set_header('Content-Type', content_type)
+                return output
+        result = self._read(pk=pk, query=queries, **controls)
+        if cache_key:
+            with self.timing.span('encode'):
+                content_type, output = encode_output(self, result)
+            self._rows_ = result_rows(result)
+            self.application.cache.set(cache_key, (content_type, output, self._rows_), ttl=self._meta.cache_ttl)
+            self.set_header('Content-Type', content_type)
+            return output
         return result
 
     @request_handler
+    @in_executor
     def post(self, *args, **kwargs):
         _logger.debug('[%s] POST>', self.__class__.__name__)
         _logger.debug('Request::headers> %s', self.request.headers)
@@ -630,21 +1244,43 @@ class ExpressHandler(RequestHandler):
         _logger.debug('Request::arguments> %s', self.request.arguments)
         self._execute_required(method='post', *args, **kwargs)
         pk = kwargs.get(self._meta.pk_regex[0], None)
-        controls, queries = query_reparse(self.request.query)
-        if pk or queries:
-            objects, ext_flds = self._update(self.request.arguments, pk=pk, query=queries)
-        else:
-            objects, ext_flds = self._create(self.request.arguments)
-        if isinstance(objects, (list, tuple)):
-            self.db_session.add_all(objects)
-        else:
-            self.db_session.add(objects)
-        self.db_session.flush()
+        with self.timing.span('parse'):
+            # `__bulk` is a control of POST only, it's popped before the query is reparsed for the other controls.
+            bulk = str2bool(self.request.query.pop('__bulk', None)) if isinstance(self.request.query, dict) else False
+            controls, queries = query_reparse(self.request.query)
+        # Filters in query means update, controls popped by query_reparse leave empty filters.
+        is_update = pk or (queries and (queries.get('__default') or len(queries) > 1))
+        bulk = self._bulk_rows(self.request.arguments) \
+            if not is_update and (bulk or self._meta.bulk_create) else None
+        if bulk:
+            with self.timing.span('execute'):
+                pks = self._bulk_create(*bulk, return_pks=self._meta.bulk_pks is not False)
+            self._cache_invalidate = True
+            result = {
+                '__ref': self.request.uri,
+                '__model': self._meta.table.__name__,
+                '__count': len(pks),
+            }
+            if self._meta.bulk_pks is not False:
+                result[self._meta.table.__name__] = pks
+            return result
+        with self.timing.span('execute'):
+            if is_update:
+                objects, ext_flds = self._update(self.request.arguments, pk=pk, query=queries)
+            else:
+                objects, ext_flds = self._create(self.request.arguments)
+            if isinstance(objects, (list, tuple)):
+                self.db_session.add_all(objects)
+            else:
+                self.db_session.add(objects)
+            self.db_session.flush()
+        self._cache_invalidate = True
         result = self._serialize(objects, extend_fields=ext_flds)
         return result
         #self.write('%s :> %s' % (self._meta.table, 'POST'))
 
     @request_handler
+    @in_executor
     def put(self, *args, **kwargs):
         _logger.debug('[%s] PUT>', self.__class__.__name__)
         _logger.debug('Request::headers> %s', self.request.headers)
@@ -654,14 +1290,18 @@ class ExpressHandler(RequestHandler):
         _logger.debug('Request::arguments> %s', self.request.arguments)
         self._execute_required(method='put', *args, **kwargs)
         pk = kwargs.get(self._meta.pk_regex[0], None)
-        controls, queries = query_reparse(self.request.query)
-        objects, ext_flds = self._update(self.request.arguments, pk=pk, query=queries)
-        self.db_session.flush()
+        with self.timing.span('parse'):
+            controls, queries = query_reparse(self.request.query)
+        with self.timing.span('execute'):
+            objects, ext_flds = self._update(self.request.arguments, pk=pk, query=queries)
+            self.db_session.flush()
+        self._cache_invalidate = True
         result = self._serialize(objects, extend_fields=ext_flds)
         return result
         #self.write('%s :> %s' % (self._meta.table, 'PUT'))
 
     @request_handler
+    @in_executor
     def delete(self, *args, **kwargs):
         _logger.debug('[%s] DELETE>', self.__class__.__name__)
         _logger.debug('Request::headers> %s', self.request.headers)
@@ -672,8 +1312,11 @@ class ExpressHandler(RequestHandler):
         #self.write('%s :> %s' % (self._meta.table, 'DELETE'))
         self._execute_required(method='delete', *args, **kwargs)
         pk = kwargs.get(self._meta.pk_regex[0], None)
-        controls, queries = query_reparse(self.request.query)
-        objects = self._delete(pk=pk, query=queries)
+        with self.timing.span('parse'):
+            controls, queries = query_reparse(self.request.query)
+        with self.timing.span('execute'):
+            objects = self._delete(pk=pk, query=queries)
+        self._cache_invalidate = True
         return self._serialize(objects)
 
     @request_handler
@@ -730,13 +1373,49 @@ class ExpressHandler(RequestHandler):
         if hasattr(self, '_db_session_'):
             return self._db_session_
         else:
-            if hasattr(self.application, 'new_db_session') and hasattr(self.application.new_db_session, '__call__'):
+            if self.request.method in REPLICA_METHODS and self._meta.replica_reads is not False and \
+                    hasattr(self.application, 'new_replica_session'):
+                sess = self.application.new_replica_session()
+            elif hasattr(self.application, 'new_db_session') and hasattr(self.application.new_db_session, '__call__'):
                 sess = self.application.new_db_session()
             else:
                 sess = None
             setattr(self, '_db_session_', sess)
             return self._db_session_
 
+    def _release_db_session(self, error=None):
+        """_release_db_session: roll back (on `error`) and close the session of request to return it's connection to the
+        pool, the replica of session is ejected when the error is a failure of it's connection. Requests never touched
+        db_session do not create a session only for releasing it.
+        """
+        sess = self.__dict__.pop('_db_session_', None)
+        if sess is None:
+            return
+        if error is not None:
+            replica_engine = getattr(sess, 'replica_engine', None)
+            if replica_engine is not None and isinstance(error, DBAPIError) and \
+                    (error.connection_invalidated or isinstance(error, OperationalError)):
+                self.application.replica_router.eject(replica_engine)
+            sess.rollback()
+        sess.close()
+
+    def stick_to_primary(self):
+        """stick_to_primary: make db_session a session of primary for the rest of request, it should be called before
+        writing anything in a GET/HEAD/OPTIONS request (which reads from replicas by default).
+        """
+        sess = getattr(self, '_db_session_', None)
+        if sess is not None and getattr(sess, 'replica_engine', None) is None:
+            return sess
+        if sess is not None:
+            sess.close()
+        self._db_session_ = self.new_db_session()
+        return self._db_session_
+
+    @property
+    def json_codec(self):
+        """Return the JSON codec of application, or the fastest installed one if the application does not have it."""
+        return getattr(self.application, 'json_codec', None) or default_json_codec
+
     def new_db_session(self, *args, **kwargs):
         """new_db_session will create a new session of SQLAlchemy.
         you can use this method to get a new session if you don't want to use a shared session from property db_session.
@@ -748,8 +1427,17 @@ class ExpressHandler(RequestHandler):
 
     def _handle_request_exception(self, e):
         self.log_exception(*sys.exc_info())
-        self.db_session.rollback()
+        self._release_db_session(error=e)
+        self._cache_invalidate = False
+        self._error_ = e.__class__.__name__
         _logger.exception('>>> %s', e)
+        if self._headers_written and not self._finished:
+            # A part of the response (eg: chunks of a streamed result) is sent already, the error can not be sent. The
+            # connection is closed before finishing, so the client sees the response truncated instead of complete.
+            gen_log.error('Cannot send error response after headers written, closing the connection.')
+            self.request.connection.stream.close()
+            self.finish()
+            return
         if self._finished:
             # Extra errors after the request has been finished should
             # be logged, but there is no reason to continue to try and
@@ -777,13 +1465,8 @@ class ExpressHandler(RequestHandler):
                 error_body[k] = kwargs.get(k)
         if self.settings.get("debug") and "exc_info" in kwargs:
             error_body['trace'] = '\n'.join(traceback.format_exception(*kwargs["exc_info"]))
-        if 'yaml' in self.request.query:
-            self.set_header('Content-Type', 'application/x-yaml')
-            output = yaml.dump(error_body)
-            _logger.debug(output)
-        else:
-            self.set_header('Content-Type', 'application/json')
-            output = json.dumps(error_body)
+        content_type, output = encode_output(self, error_body)
+        self.set_header('Content-Type', content_type)
         self.write(output)
         self.finish()
 
@@ -808,8 +1491,54 @@ class ExpressHandler(RequestHandler):
             self._handle_request_exception(e)
 
     def finish(self, chunk=None):
+        # The session is committed (only when it has anything to commit) and closed to return the connection to pool
+        # before the response is flushed. Requests never touched db_session do not create a session at all.
+        sess = self.__dict__.pop('_db_session_', None)
+        if sess is not None:
+            try:
+                if session_has_writes(sess):
+                    with self.timing.span('commit'):
+                        sess.commit()
+            except Exception:
+                sess.rollback()
+                sess.close()
+                self._cache_invalidate = False
+                raise
+            sess.close()
+        if self.timing.enabled:
+            for sink in self.application.timing_sinks:
+                sink.record(self, self.timing)
         super(ExpressHandler, self).finish(chunk=chunk)
-        self.db_session.commit()
+        if getattr(self, '_cache_invalidate', False) and getattr(self.application, 'cache', None) is not None:
+            for t in self._cache_tables():
+                bump_generation(self.application.cache, t)
+
+    def on_connection_close(self):
+        # Stop the writers of chunks waiting for a flush which will never complete.
+        future = getattr(self, '_flush_future_', None)
+        if future is not None and not future.done():
+            future.set_result(False)
+
+    def on_finish(self):
+        if self._metrics_ is not None:
+            self._metrics_.observe(self.__class__.__name__, self._route_, self.request.method, self.get_status(),
+                                   self.request.request_time(), error=self._error_, rows=self._rows_)
+
+    @classmethod
+    def _cache_tables(cls):
+        """_cache_tables: names of the tables which the cached responses of this handler depend on, including the
+        table of handler, the tables of it's relationships and the secondary tables.
+        """
+        if '_cache_tables_' not in cls.__dict__:
+            tables = set()
+            if cls._meta.table is not None:
+                tables.add(cls._meta.table.__table__.name)
+                for r in cls._meta.table.__mapper__.relationships.values():
+                    tables.add(r.mapper.class_.__table__.name)
+                    if r.secondary is not None:
+                        tables.add(r.secondary.name)
+            cls._cache_tables_ = sorted(tables)
+        return cls._cache_tables_
 
     @classmethod
     def _get_encoder(cls, column):
@@ -851,47 +1580,26 @@ class ExpressHandler(RequestHandler):
             relpath = self.path_kwargs.get('relpath', None)
             if relpath is not None:
                 relpath = relpath.lstrip('/')
-            _logger.debug('relpath: %s', relpath)
             if relpath:
-                method = None
-                _logger.debug('Matching routes ...')
-                for spec in self._meta.routes:
-                    match = spec.regex.match(relpath)
-                    if match:
-                        _logger.debug('Matched route %s ...', spec)
-                        if spec.methods and self.request.method not in spec.methods:
-                            raise exceptions.MethodNotAllowed()
-                        method = spec.request_handler
-                        if spec.regex.groups:
-                            if spec.regex.groupindex:
-                                self.path_kwargs = dict(
-                                    (str(k), unquote(v))
-                                    for (k, v) in match.groupdict().items())
-                            else:
-                                self.path_args = [unquote(s) for s in match.groups()]
-                        break
-                ### else:
-                if not method:
-                    _logger.debug('Matching pk_spec ...')
-                    spec = self._meta.pk_spec
-                    _logger.debug('Matching pk_spec ...spec=%s, relpath=%s', spec, relpath)
-                    match = spec.regex.match(relpath) if spec else None
-                    _logger.debug('Matching pk_spec ...match=%s', match)
-                    if match:
-                        if spec.regex.groups:
-                            if spec.regex.groupindex:
-                                self.path_kwargs = dict(
-                                    (str(k), unquote(v))
-                                    for (k, v) in match.groupdict().items())
-                            else:
-                                self.path_args = [unquote(s) for s in match.groups()]
-                        method = getattr(self, self.request.method.lower())
-                        self._when_complete(method(*self.path_args, **self.path_kwargs),
-                                            self._execute_finish)
+                spec, match = self._meta.dispatcher.match(relpath)
+                if spec is None:
+                    raise exceptions.NotFound(message='Pk not found!')
+                self._route_ = spec.regex.pattern
+                if spec.allowed_methods and self.request.method not in spec.allowed_methods:
+                    raise exceptions.MethodNotAllowed()
+                if spec.regex.groups:
+                    if spec.regex.groupindex:
+                        self.path_kwargs = dict(
+                            (str(k), unquote(v))
+                            for (k, v) in match.groupdict().items())
                     else:
-                        raise exceptions.NotFound(message='Pk not found!')
+                        self.path_args = [unquote(s) for s in match.groups()]
+                if spec is self._meta.pk_spec:
+                    method = getattr(self, self.request.method.lower())
+                    self._when_complete(method(*self.path_args, **self.path_kwargs),
+                                        self._execute_finish)
                 else:
-                    self._when_complete(method(self, *self.path_args, **self.path_kwargs),
+                    self._when_complete(spec.request_handler(self, *self.path_args, **self.path_kwargs),
                                         self._execute_finish)
             else:
                 _logger.debug('Go upper ...')
@@ -907,7 +1615,12 @@ class ExpressHandler(RequestHandler):
                    extend_fields=None,
                    order_by=None,
                    begin=None,
-                   limit=None):
+                   limit=None,
+                   total=None,
+                   after=None,
+                   stream=False,
+                   statement_key=None,
+                   params=None):
         """_serialize generate a dictionary from a queryset instance `inst` according to the meta controled by handler
         and the following arguments:
         `include_fields`: a list of field names want to included in output;
@@ -915,13 +1628,22 @@ class ExpressHandler(RequestHandler):
         `extend_fields`: a list of foreignkey field names and m2m or related attributes with other relationships;
         `order_by`: a list of field names for ordering the output;
         `limit`: an integer to limit the number of records to output, 50 by default;
+        `total`: how to count the matched records for `__total`, one of 'exact' (by default, 'none' by default of
+            query_reparse in keyset mode), 'estimate' and 'none';
+        `after`: the cursor for keyset pagination, `begin` is ignored when it is given (an empty string starts from the
+            first page), records are sorted by `order_by` and primary key, and `__next` is the cursor of next page
+            (null for the last page). Columns used by keyset pagination should not be nullable;
+        `stream`: records will be a StreamedRecords which is fetched, serialized and written out row by row by
+            request_handler, `__count` (and `__next`) will be written after the records;
+        `statement_key`: the key of shape of query `inst` whose filters are bound by `params`, the statements of count
+            and records (of the first page in offset mode) are taken from the statement cache of application by it;
         Return dictionary will like:
         {
             '__ref': '$(HTTP_REQUEST_URI)',
             '__total': $(NUM_OF_MACHED_RECORDS),
             '__count': $(NUM_OF_RETURNED_RECORDS),
             '__limit': $(LIMIT_NUM),
-            '__begin': $(OFFSET),
+            '__begin': $(OFFSET),  ## Or '__after': $(CURSOR), '__next': $(NEXT_CURSOR) in keyset mode
             '__model': '$(NAME_OF_MODEL)',
             '$(NAME_OF_MODEL)': [$(LIST_OF_RECORDS)], ## For multiple records mode
             '$(NAME_OF_MODEL)': {$(RECORD)}, ## For one record mode
@@ -933,34 +1655,107 @@ class ExpressHandler(RequestHandler):
         }
 
         meta = self._meta
+        # Only the requested columns are queried when no relationship needs to be extended.
+        projection = bool(include_fields) and not extend_fields
         #if meta.invisible:
         #    exclude_fields = exclude_fields.extend(meta.invisible) if exclude_fields else meta.invisible
-        include_fields = list((set(include_fields or meta.table.__mapper__.columns.keys()) - set(exclude_fields or []))
-                              | set(meta.table.__table__.primary_key.columns.keys()))
+        info = model_info(meta.table)
+        include_fields = list((set(include_fields or info.attributes) - set(exclude_fields or []))
+                              | set(info.pk_names))
         if extend_fields:
             _logger.debug('extend_fields: %s', extend_fields)
             pass
         if isinstance(inst, Query):
             begin = begin or 0
             limit = 50 if limit is None else limit
+            with self.timing.span('execute'):
+                if total == 'none':
+                    count = None
+                elif total == 'estimate':
+                    count = estimate_count(inst)
+                elif statement_key is not None:
+                    count = self.application.statement_cache.execute(
+                        self.db_session, meta.table.__mapper__, statement_key + ('__count', ),
+                        lambda: count_statement(inst), params).scalar()
+                else:
+                    count = inst.count()
             result.update({
-                '__total': inst.count(),
-                '__count': inst.count(),
+                '__total': count,
                 '__limit': limit,
-                '__begin': begin,
             })
-            if order_by:
-                joins, orderbys = build_order_by(meta.table, order_by)
-                if orderbys:
-                    inst = inst.order_by(*orderbys)
-            if limit >= 0:
-                inst = inst.slice(begin, begin+limit)  # inst[begin:begin+limit]
-            result[self._meta.table.__name__] = serialize(meta.table, inst, include_fields=include_fields, extend_fields=extend_fields)
-             # list(inst.values(*[getattr(self._meta.table, x) for x in include_fields]))
+            if after is not None:
+                keys = build_keyset(meta.table, order_by)
+                inst = inst.order_by(*[desc(c) if d else asc(c) for c, d in keys])
+                if after:
+                    try:
+                        values = decode_cursor(after)
+                    except ValueError:
+                        raise exceptions.InvalidExpression(message='Invalid cursor!')
+                    inst = inst.filter(keyset_filter(keys, values, query_dialect(inst).name))
+                if limit >= 0:
+                    inst = inst.limit(limit)
+                result['__after'] = after
+                if stream:
+                    result[self._meta.table.__name__] = StreamedRecords(
+                        meta.table, inst, include_fields=include_fields, extend_fields=extend_fields,
+                        projection=projection, keys=[c for c, d in keys], limit=limit)
+                    return result
+                if projection:
+                    with self.timing.span('execute'):
+                        objs, last = serialize_projection(meta.table, inst, include_fields=include_fields,
+                                                          keys=[c for c, d in keys])
+                else:
+                    with self.timing.span('execute'):
+                        rows = inst.all()
+                    with self.timing.span('serialize'):
+                        objs = serialize(meta.table, rows, include_fields=include_fields, extend_fields=extend_fields)
+                    last = tuple(getattr(rows[-1], c.key) for c, d in keys) if rows else None
+                result[self._meta.table.__name__] = objs
+                result['__next'] = encode_cursor(last) if last and 0 <= limit <= len(objs) else None
+            else:
+                result['__begin'] = begin
+                if order_by:
+                    joins, orderbys = build_order_by(meta.table, order_by)
+                    if orderbys:
+                        inst = inst.order_by(*orderbys)
+                if limit >= 0:
+                    inst = inst.slice(begin, begin+limit)  # inst[begin:begin+limit]
+                if stream:
+                    result[self._meta.table.__name__] = StreamedRecords(
+                        meta.table, inst, include_fields=include_fields, extend_fields=extend_fields,
+                        projection=projection)
+                    return result
+                if begin:
+                    # Statements of pages by offset are not cached, the offset can not be bound in SQLAlchemy 0.8 so
+                    # each offset would be cached and compiled as a statement of it's own, pushing the hot shapes out.
+                    statement_key = None
+                if statement_key is not None:
+                    statement_key += (tuple(order_by or ()), limit)
+                if projection and statement_key is not None:
+                    fields = get_serialize_plan(meta.table, include_fields=include_fields).fields
+                    with self.timing.span('execute'):
+                        rows = self.application.statement_cache.execute(
+                            self.db_session, meta.table.__mapper__, statement_key + (fields, ),
+                            lambda: inst.with_entities(*[getattr(meta.table, f) for f in fields]).statement, params)
+                        result[self._meta.table.__name__] = [dict(zip(fields, row)) for row in rows]
+                elif projection:
+                    with self.timing.span('execute'):
+                        result[self._meta.table.__name__] = serialize_projection(meta.table, inst, include_fields=include_fields)
+                else:
+                    if statement_key is not None:
+                        inst = self.application.statement_cache.query(self.db_session.query(meta.table), statement_key,
+                                                                      lambda q=inst: q.statement, params)
+                    with self.timing.span('execute'):
+                        rows = inst.all()
+                    with self.timing.span('serialize'):
+                        result[self._meta.table.__name__] = serialize(meta.table, rows, include_fields=include_fields, extend_fields=extend_fields)
+                 # list(inst.values(*[getattr(self._meta.table, x) for x in include_fields]))
+            result['__count'] = len(result[self._meta.table.__name__])
         else:
             _logger.debug("Inst >>> %s", inst)
             _logger.debug("Include Fields: %s", include_fields)
-            objs = serialize(meta.table, inst, include_fields=include_fields, extend_fields=extend_fields)
+            with self.timing.span('serialize'):
+                objs = serialize(meta.table, inst, include_fields=include_fields, extend_fields=extend_fields)
             if isinstance(objs, (list, tuple)):
                 result[self._meta.table.__name__] = objs
                 result['__count'] = len(objs)
@@ -989,55 +1784,69 @@ class ExpressHandler(RequestHandler):
             object_data[key] = vf(object_data[key])
         return object_data
 
-    def _build_filter(self, key, value):
+    def _build_filter(self, key, value, name=None, params=None):
         assert key
         flt, jns = build_filter(self._meta.table,
-                                key.split('.') if isinstance(key, (str, unicode)) else key, value, joins=None)
+                                key.split('.') if isinstance(key, (str, unicode)) else key, value, joins=None,
+                                name=name, params=params)
         _logger.debug('_build_filter >>> %s | %s', flt, jns)
         return flt, jns
 
-    def _query(self, query=None):
+    def _has_filters(self, query):
+        """_has_filters: check if the reparsed `query` has any filter of table, the keys which are not filters are
+        skipped by _query, a query of them only would update or delete all the records.
+        """
+        return any(compile_filter(self._meta.table, k) is not None for conditions in query.values() for k in conditions)
+
+    def _query(self, query=None, params=None):
         """_query: return a Query instance according to the giving query data.
+        When a dictionary `params` is given, the values of filters are bound by named parameters collected into it
+        (applied to the Query by Query.params) instead of being embedded, the parameters are named in the order of
+        sorted groups and keys, so they are the same for queries of the same shape.
         """
         inst = self.db_session.query(self._meta.table)
         if not query:
             return inst
+
+        def _name_():
+            return 'p%d' % len(params) if params is not None else None
+
+        groups = list()
         default_query = query.pop('__default', None)
         if default_query:
-            filters = list()
-            joins = list()
-            for k, v in default_query.items():
-                f, j = self._build_filter(k, v)
-                if f is not None:
-                    filters.append(f)
-                    if j is not None:
-                        joins.extend(j)
-            _logger.debug('[default] filters: %s', filters)
-            _logger.debug('[default] joins: %s', joins)
-            for j in joins:
-                inst = inst.join(j)
-            if filters:
-                inst = inst.filter(and_(*filters))
-        for pair, conditions in query.items():
-            filters, joins = list(), list()
-            for k, v in conditions.items():
-                f, j = self._build_filter(k, v)
-                if f is not None:
-                    filters.append(f)
-                    if j is not None:
-                        joins.extend(j)
+            groups.append(('default', default_query, and_))
+        groups.extend((pair, conditions, or_) for pair, conditions in sorted(query.items()))
+        joined = set()  # Each relationship is joined once, however many filters are on it.
+        for pair, conditions, conjunction in groups:
+            filters, exists = list(), OrderedDict()
+            for k, v in sorted(conditions.items()):
+                f, j = self._build_filter(k, v, name=_name_(), params=params)
+                if f is None:
+                    continue
+                j = j or []
+                if self._meta.exists_filters is not False and any(x.property.uselist for x in j):
+                    # Filters on the same collection are combined into one EXISTS.
+                    exists.setdefault(tuple(str(x) for x in j), (j, list()))[1].append(f)
+                    continue
+                filters.append(f)
+                for x in j:
+                    if str(x) not in joined:
+                        joined.add(str(x))
+                        inst = inst.join(x)
+            for j, fs in exists.values():
+                filters.append(exists_criteria(j, conjunction(*fs)))
             _logger.debug('[%s] filters: %s', pair, filters)
-            _logger.debug('[%s] joins: %s', pair, joins)
-            for j in joins:
-                inst = inst.join(j)
+            _logger.debug('[%s] joins: %s', pair, joined)
             if filters:
-                inst = inst.filter(or_(*filters))
+                inst = inst.filter(conjunction(*filters))
+        if params:
+            inst = inst.params(params)
         return inst
 
     def _read(self, pk=None, query=None,
-              include_fields=None, exclude_fields=None, extend_fields=None, order_by=None, begin=None, limit=None):
+              include_fields=None, exclude_fields=None, extend_fields=None, order_by=None, begin=None, limit=None,
+              total=None, after=None, stream=False):
         """_read: read record(s) from table."""
-        t1 = log_timing(msg='READ START:::')
         _logger.debug('%s:> _read', self.__class__.__name__)
         _logger.debug('pk: %s', pk)
         _logger.debug('query: %s', query)
@@ -1047,29 +1856,41 @@ class ExpressHandler(RequestHandler):
         _logger.debug('order_by: %s', order_by)
         _logger.debug('begin: %s', begin)
         _logger.debug('limit: %s', limit)
-        join_loads = find_join_loads(self._meta.table, extend_fields)
-        t11 = log_timing(tm=t1, msg='READ JOIN LOADS 1 DONE:::')
-        join_loads = [joinedload(x) for x in join_loads] if join_loads else None
+        with self.timing.span('query-build'):
+            join_loads = find_join_loads(self._meta.table, extend_fields)
+            join_loads = build_loaders(self._meta.table, join_loads, self._meta.loaders) if join_loads else None
         _logger.debug('join_loads: %s', join_loads)
-        t2 = log_timing(tm=t11, msg='READ JOIN LOADS 2 DONE:::')
+        statement_key, params = None, None
         if pk:
-            inst = self.db_session.query(self._meta.table).options(*join_loads).get(pk) if join_loads \
-                else self.db_session.query(self._meta.table).get(pk)
+            with self.timing.span('execute'):
+                inst = self.db_session.query(self._meta.table).options(*join_loads).get(pk) if join_loads \
+                    else self.db_session.query(self._meta.table).get(pk)
             if not inst:
                 raise exceptions.NotFound()
         else:
-            inst = self._query(query)
-            if join_loads:
-                inst = inst.options(*join_loads)
+            with self.timing.span('query-build'):
+                statement_cache = getattr(self.application, 'statement_cache', None)
+                if statement_cache is not None and statement_cache.enabled and not join_loads and after is None \
+                        and not stream:
+                    params = dict()
+                    statement_key = (self.__class__, query_shape(query))
+                inst = self._query(query, params=params)
+                if statement_key is not None:
+                    statement_key += (tuple(sorted(params)), )
+                if join_loads:
+                    inst = inst.options(*join_loads)
         _logger.debug('Inst: %s', type(inst))
-        t3 = log_timing(tm=t2, msg='READ QUERY DONE:::')
         result = self._serialize(inst, include_fields=include_fields,
                                  exclude_fields=exclude_fields,
                                  extend_fields=extend_fields,
                                  order_by=order_by,
                                  begin=begin,
-                                 limit=limit)
-        log_timing(tm=t3, msg='READ SERIALIZE DONE:::')
+                                 limit=limit,
+                                 total=total,
+                                 after=after,
+                                 stream=stream,
+                                 statement_key=statement_key,
+                                 params=params)
         return result
 
     def _create(self, arguments):
@@ -1077,6 +1898,8 @@ class ExpressHandler(RequestHandler):
         _logger.debug('%s:> _create', self.__class__.__name__)
         _logger.debug('arguments: %s', arguments)
         ext_flds = list()
+        info = model_info(self._meta.table)
+        related = self._resolve_related(arguments)
 
         def _do_create_obj(data):
             assert isinstance(data, dict)
@@ -1084,9 +1907,9 @@ class ExpressHandler(RequestHandler):
             objdata = {}
 
             for k, v in data.items():
-                if k in self._meta.table.__table__.c.keys():
+                if k in info.columns:
                     objdata[k] = v
-                elif k in self._meta.table.__mapper__.relationships.keys():
+                elif k in info.relationships:
                     relatedobjs[k] = v
                 else:
                     pass
@@ -1095,11 +1918,11 @@ class ExpressHandler(RequestHandler):
             objdata = self._update_object_data(self._encode_object_data(self._validate_object_data(objdata)))
             obj = self._meta.table(**objdata)
             for k, v in relatedobjs.items():
-                related_instrument = self._meta.table.__mapper__.relationships[k]
-                related_class = related_instrument.mapper.class_
-                related_class_pk_name = related_class.__table__.primary_key.columns.keys()[0]
+                related_class = info.targets[k]
+                related_class_pk_name = model_info(related_class).pk_names[0]
                 exits_objs, new_objs, new_obj_datas = None, None, None
                 _logger.debug('%s: %s', k, v)
+                found, normalize = related[k]
                 if isinstance(v, (list, tuple)):
                     pks = map(lambda m: m[related_class_pk_name] if isinstance(m, dict) else m,
                               filter(lambda itm: True if (isinstance(itm, dict) and related_class_pk_name in itm)
@@ -1107,18 +1930,20 @@ class ExpressHandler(RequestHandler):
                     _logger.debug('pks = %s', pks)
                     new_obj_datas = filter(lambda m: isinstance(m, dict) and related_class_pk_name not in m, v)
                     if pks:
-                        exits_objs = self.db_session.query(related_class).\
-                            filter(getattr(related_class, related_class_pk_name).in_(pks)).all()
+                        exits_objs = list()
+                        for x in map(normalize, pks):
+                            if x in found and found[x] not in exits_objs:
+                                exits_objs.append(found[x])
                         _logger.debug('exits_objs = %s', exits_objs)
                 elif isinstance(v, dict):
                     if related_class_pk_name in v:
-                        exits_objs = self.db_session.query(related_class).get(v[related_class_pk_name])
+                        exits_objs = found.get(normalize(v[related_class_pk_name]))
                         if not exits_objs:
                             raise exceptions.NotFound(message='%s with pk "%s" was not found!' % (k, v))
                     else:
                         new_obj_datas = v
                 else:
-                    exits_objs = self.db_session.query(related_class).get(v)
+                    exits_objs = found.get(normalize(v))
                     if not exits_objs:
                         raise exceptions.NotFound(message='%s with pk "%s" was not found!' % (k, v))
                 if new_obj_datas:
@@ -1156,6 +1981,129 @@ class ExpressHandler(RequestHandler):
         _logger.debug('objects: %s', objects)
         return objects, list(set(ext_flds))
 
+    def _resolve_related(self, arguments):
+        """_resolve_related: collect the pks of related objects referenced by relationships across the whole payload
+        of _create, and fetch each related class once with IN (...) instead of one query per object and relationship.
+        Returns a dictionary of relationship name to a tuple of ({key: related_object}, normalize), where `normalize`
+        converts a pk from payload into the key for looking up (None for an invalid pk), see _pk_key_.
+        """
+        info = model_info(self._meta.table)
+        collected = dict()
+        for data in (arguments if isinstance(arguments, (list, tuple)) else [arguments]):
+            if not isinstance(data, dict):
+                continue
+            for k, v in data.items():
+                if k in info.columns or k not in info.relationships:
+                    continue
+                if k not in collected:
+                    pk_column = model_info(info.targets[k]).pk_columns[0]
+                    dialect = self.db_session.get_bind(info.targets[k].__mapper__).dialect
+                    collected[k] = (pk_column, _pk_normalizer_(pk_column), _pk_key_(pk_column, dialect), dict())
+                pk_column, normalize, key, pks = collected[k]
+                for m in (v if isinstance(v, (list, tuple)) else [v]):
+                    if isinstance(m, dict):
+                        if pk_column.key not in m:
+                            continue
+                        m = m[pk_column.key]
+                    if key(m) is not None:
+                        pks[key(m)] = normalize(m)
+        result = dict()
+        for k, (pk_column, normalize, key, pks) in collected.items():
+            related_class = info.targets[k]
+            pk = getattr(related_class, pk_column.key)
+            objs = self.db_session.query(related_class).filter(pk.in_(pks.values())).all() if pks else []
+            result[k] = (dict((key(getattr(o, pk_column.key)), o) for o in objs), key)
+        return result
+
+    def _bulk_rows(self, arguments):
+        """_bulk_rows: convert a list payload into rows of column values for _bulk_create.
+        Only flat objects are supported: the keys should be columns, or many-to-one relationships referencing the
+        primary key of related object (a pk value or a dictionary with pk) which are converted to the foreign key
+        column. Returns a tuple of (rows, references) where references is a dictionary of foreign key column to the
+        relationship name, or None if the payload can not be created in bulk mode (eg: with nested new objects or
+        collections), it should go to _create then.
+        """
+        if not isinstance(arguments, (list, tuple)) or not arguments:
+            return None
+        info = model_info(self._meta.table)
+        relationships = self._meta.table.__mapper__.relationships
+        rows = list()
+        references = dict()
+        for data in arguments:
+            if not isinstance(data, dict):
+                return None
+            row = dict()
+            for k, v in data.items():
+                if k in info.columns:
+                    row[k] = v
+                elif k in info.relationships:
+                    rel = relationships[k]
+                    related_pks = model_info(rel.mapper.class_).pk_columns
+                    if rel.direction.name != 'MANYTOONE' or len(rel.local_remote_pairs) != 1 or \
+                            len(related_pks) != 1 or rel.local_remote_pairs[0][1] is not related_pks[0]:
+                        return None
+                    if isinstance(v, dict):
+                        if related_pks[0].key not in v:
+                            return None
+                        v = v[related_pks[0].key]
+                    elif isinstance(v, (list, tuple)):
+                        return None
+                    fk = rel.local_remote_pairs[0][0].key
+                    row[fk] = v
+                    references[fk] = k
+            if not row:
+                raise exceptions.InvalidData(message='Invalid data! Empty object is not allowed!')
+            rows.append(row)
+        return rows, references
+
+    def _bulk_create(self, rows, references=None, chunk_size=1000, return_pks=True):
+        """_bulk_create: create records in bulk from rows returned by _bulk_rows, without building ORM objects.
+        Related pks are checked with one IN query per relationship, then rows are inserted in chunks of `chunk_size`:
+        by executemany when the pks are given or not `return_pks`, or by a multi-row INSERT ... RETURNING on dialects
+        support it, or row by row (still without ORM) otherwise. Returns a list of dictionaries of the pks of created
+        records in the order of rows (None for each record when not `return_pks`).
+        """
+        table = self._meta.table
+        info = model_info(table)
+        pk_columns, pk_names = info.pk_columns, info.pk_names
+        rows = [self._update_object_data(self._encode_object_data(self._validate_object_data(row))) for row in rows]
+        for fk, relname in (references or {}).items():
+            related_pk = model_info(info.targets[relname]).pk_columns[0]
+            key = _pk_key_(related_pk, self.db_session.get_bind(info.targets[relname].__mapper__).dialect)
+            pks = dict((key(row[fk]), row[fk]) for row in rows if row.get(fk) is not None)
+            if not pks:
+                continue
+            values = [v for k, v in pks.items() if k is not None]
+            found = set(key(x[0]) for x in self.db_session.query(related_pk).filter(related_pk.in_(values))) \
+                if values else set()
+            for k in set(pks) - found:
+                raise exceptions.NotFound(message='%s with pk "%s" was not found!' % (relname, pks[k]))
+        groups = OrderedDict()  # Rows with the same keys are inserted together, with their indices in rows.
+        for i, row in enumerate(rows):
+            groups.setdefault(tuple(sorted(row.keys())), list()).append((i, row))
+        dialect = self.db_session.get_bind(table.__mapper__).dialect
+        returning = getattr(dialect, 'implicit_returning', False) and \
+            getattr(dialect, 'supports_multivalues_insert', False)
+        insert = table.__table__.insert()
+        result = [None] * len(rows)
+        for keys, group in groups.items():
+            for i in range(0, len(group), chunk_size):
+                indices, chunk = zip(*group[i:i + chunk_size])
+                chunk = list(chunk)
+                if not return_pks or all(k in keys for k in pk_names):
+                    self.db_session.execute(insert, chunk)
+                    created = [dict((k, r[k]) for k in pk_names) for r in chunk] if return_pks else []
+                elif returning:
+                    rs = self.db_session.execute(insert.values(chunk).returning(*pk_columns))
+                    created = [dict(zip(pk_names, r)) for r in rs]
+                else:
+                    created = [dict(zip(pk_names, self.db_session.execute(insert, r).inserted_primary_key))
+                               for r in chunk]
+                for n, pk in zip(indices, created):
+                    result[n] = pk
+        mark_written(self.db_session)
+        return result
+
     def _update(self, arguments, pk=None, query=None):
         """_update: Update record(s) according to query."""
         _logger.debug('%s:> _update', self.__class__.__name__)
@@ -1178,6 +2126,8 @@ class ExpressHandler(RequestHandler):
             self.db_session.add(inst)
             result = inst
         elif query:
+            if not self._has_filters(query):
+                raise exceptions.InvalidExpression(message='No filter in query!')
             inst = self._query(query)
             if not isinstance(arguments, dict) or not arguments:
                 raise exceptions.InvalidData()
@@ -1185,8 +2135,10 @@ class ExpressHandler(RequestHandler):
             for k, v in arguments.items():
                 if k in self._meta.readonly:
                     raise exceptions.InvalidData(message='Column(%s) is read-only!' % k)
-            inst.update(arguments)
-            result = inst
+                if k not in model_info(self._meta.table).attributes:
+                    raise exceptions.InvalidData(message='Column(%s) does not exist!' % k)
+            self._check_affected(inst)
+            result = self._bulk_update(inst, arguments)
         else:
             pass
         self.db_session.flush()
@@ -1201,13 +2153,71 @@ class ExpressHandler(RequestHandler):
             inst = self.db_session.query(self._meta.table).get(pk)
             if not inst:
                 raise exceptions.NotFound()
-            result = {self._meta.table.__table__.primary_key.columns.keys()[0]: pk}
+            result = {model_info(self._meta.table).pk_names[0]: pk}
             self.db_session.delete(inst)
         else:
+            if query and not self._has_filters(query):
+                raise exceptions.InvalidExpression(message='No filter in query!')
             inst = self._query(query)
-            result = map(lambda x: x._asdict(), inst.values(*self._meta.table.__table__.primary_key.columns.values()))
-                #map(lambda x: {self._meta.table.__table__.primary_key.columns.keys()[0]: x},
-                #         inst.values(self._meta.table.__table__.primary_key.columns.values()[0]))
-            inst.delete()
+            self._check_affected(inst)
+            result = self._bulk_delete(inst)
+
+        return result
+
+    def _check_affected(self, inst):
+        """_check_affected: raise TooManyRecords when query `inst` matches more records than `max_affected_rows` (of
+        Meta, or the application settings), only the first max_affected_rows + 1 records are counted.
+        """
+        max_rows = self._meta.max_affected_rows
+        if max_rows is None:
+            max_rows = self.application.settings.get('max_affected_rows')
+        if max_rows is None:
+            return
+        if inst.limit(max_rows + 1).count() > max_rows:
+            raise exceptions.TooManyRecords(message='More than %s records would be affected!' % max_rows)
+
+    def _bulk_update(self, inst, arguments, chunk_size=1000):
+        """_bulk_update: update the records matched by query `inst` with set-based UPDATE statements instead of loading
+        them. On dialects support RETURNING, it's a single UPDATE ... WHERE pk IN (SELECT ...) RETURNING which returns
+        the updated records; otherwise the pks are walked in chunks of `chunk_size`, each chunk is updated and read back
+        by pk. Returns a list of serialized records.
+        """
+        cls = self._meta.table
+        table = cls.__table__
+        pk_columns = model_info(cls).pk_columns
+        fields = get_serialize_plan(cls).fields
+        columns = [cls.__mapper__.columns[f].label(f) for f in fields]
+        values = dict((cls.__mapper__.columns[k], v) for k, v in arguments.items())
+        dialect = self.db_session.get_bind(cls.__mapper__).dialect
+        if supports_returning(dialect, 'update'):
+            where = pk_criteria(pk_columns, inst.with_entities(*pk_columns).statement.correlate(None))
+            rs = self.db_session.execute(table.update().where(where).values(values).returning(*columns))
+            result = [dict(zip(fields, r)) for r in rs]
+        else:
+            result = list()
+            for chunk in pk_chunks(inst, pk_columns, chunk_size):
+                where = pk_criteria(pk_columns, chunk)
+                self.db_session.execute(table.update().where(where).values(values))
+                result.extend(dict(zip(fields, r)) for r in self.db_session.execute(select(columns).where(where)))
+        mark_written(self.db_session)
+        return result
 
+    def _bulk_delete(self, inst, chunk_size=1000):
+        """_bulk_delete: delete the records matched by query `inst` with set-based DELETE statements. On dialects support
+        RETURNING, it's a single DELETE ... WHERE pk IN (SELECT ...) RETURNING pk; otherwise the pks are walked and
+        deleted in chunks of `chunk_size`. Returns a list of dictionaries of the pks of deleted records.
+        """
+        table = self._meta.table.__table__
+        pk_columns, pk_names = model_info(self._meta.table).pk_columns, model_info(self._meta.table).pk_names
+        dialect = self.db_session.get_bind(self._meta.table.__mapper__).dialect
+        if supports_returning(dialect, 'delete'):
+            where = pk_criteria(pk_columns, inst.with_entities(*pk_columns).statement.correlate(None))
+            rs = self.db_session.execute(table.delete().where(where).returning(*pk_columns))
+            result = [dict(zip(pk_names, r)) for r in rs]
+        else:
+            result = list()
+            for chunk in pk_chunks(inst, pk_columns, chunk_size):
+                self.db_session.execute(table.delete().where(pk_criteria(pk_columns, chunk)))
+                result.extend(dict(zip(pk_names, r)) for r in chunk)
+        mark_written(self.db_session)
         return result
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import uuid
+import base64
 import decimal
 import datetime
+import simplejson as json
 from sqlalchemy import Column, Integer, Float, Numeric, SmallInteger, BigInteger
 from sqlalchemy import DateTime, Date, Time, Boolean
 # from sqlalchemy import Text, String, Unicode
@@ -81,6 +84,73 @@ def simple_field_processor(column):
     return pf
 
 
+class ModelInfo(object):
+    """ModelInfo: the introspection data of a model which the hot paths (build_filter, serializers, handlers) look up on
+    every request and every row, built once per model by model_info().
+        - columns: names of the table columns;
+        - attributes: keys of the mapped columns;
+        - pk_columns/pk_names: primary key columns and their names, in order;
+        - processors: simple_field_processor of the mapped columns by column name;
+        - relationships/collections: names of all the relationships and the ones with uselist;
+        - targets: relationship name to the related model;
+        - encoders: encoders of the handler of the model (empty when it has no handler).
+    The relationship parts are built on first access, the mappers may not be configured yet when the columns are
+    inspected (eg: while the handler classes are being created).
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        self.columns = frozenset(cls.__table__.c.keys())
+        self.attributes = frozenset(cls.__mapper__.c.keys())
+        self.pk_columns = tuple(cls.__table__.primary_key.columns.values())
+        self.pk_names = tuple(c.key for c in self.pk_columns)
+        self.processors = dict()
+        for c in cls.__mapper__.c.values():
+            pf = simple_field_processor(c)
+            if pf is not None:
+                self.processors[c.name] = pf
+        self._targets = None
+
+    def _inspect_relationships_(self):
+        relationships = self.cls.__mapper__.relationships
+        self._collections = frozenset(k for k, r in relationships.items() if r.uselist)
+        self._targets = dict((k, r.mapper.class_) for k, r in relationships.items())
+        self._relationships = frozenset(self._targets.keys())
+
+    @property
+    def relationships(self):
+        if self._targets is None:
+            self._inspect_relationships_()
+        return self._relationships
+
+    @property
+    def collections(self):
+        if self._targets is None:
+            self._inspect_relationships_()
+        return self._collections
+
+    @property
+    def targets(self):
+        if self._targets is None:
+            self._inspect_relationships_()
+        return self._targets
+
+    @property
+    def encoders(self):
+        handler = getattr(self.cls, '__handler__', None)
+        return handler._meta.encoders if handler is not None else {}
+
+
+_model_infos_ = dict()
+
+
+def model_info(cls):
+    """model_info: return the ModelInfo of model `cls`, it's built on the first call and kept for the process."""
+    info = _model_infos_.get(cls)
+    if info is None:
+        info = _model_infos_[cls] = ModelInfo(cls)
+    return info
+
+
 def joinlists(skip_none=True, *args):
     ret = list()
     for x in args:
@@ -90,4 +160,54 @@ def joinlists(skip_none=True, *args):
             ret.append(x)
         elif not skip_none:
             ret.append(x)
-    return ret
\ No newline at end of file
+    return ret
+
+
+def _cursor_value_(v):
+    if isinstance(v, datetime.datetime):
+        return {'$dt': v.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(v, datetime.date):
+        return {'$d': v.strftime('%Y-%m-%d')}
+    if isinstance(v, datetime.time):
+        return {'$t': v.strftime('%H:%M:%S.%f')}
+    if isinstance(v, decimal.Decimal):
+        return {'$dec': str(v)}
+    if isinstance(v, uuid.UUID):
+        return {'$uuid': v.hex}
+    return v
+
+
+def _cursor_unvalue_(v):
+    if not isinstance(v, dict):
+        return v
+    if '$dt' in v:
+        return datetime.datetime.strptime(v['$dt'], '%Y-%m-%dT%H:%M:%S.%f')
+    if '$d' in v:
+        return datetime.datetime.strptime(v['$d'], '%Y-%m-%d').date()
+    if '$t' in v:
+        return datetime.datetime.strptime(v['$t'], '%H:%M:%S.%f').time()
+    if '$dec' in v:
+        return decimal.Decimal(v['$dec'])
+    if '$uuid' in v:
+        return uuid.UUID(v['$uuid'])
+    raise ValueError('Unknown cursor value: %r' % v)
+
+
+def encode_cursor(values):
+    """encode_cursor: encode a tuple of column values (the sort keys of the last row of a page) into an opaque string
+    which is safe to be used in url query.
+    """
+    return base64.urlsafe_b64encode(json.dumps([_cursor_value_(v) for v in values], separators=(',', ':')))
+
+
+def decode_cursor(cursor):
+    """decode_cursor: decode the string from encode_cursor back into a list of column values.
+    ValueError will be raised if the cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except Exception, e:
+        raise ValueError('Invalid cursor: %s' % e)
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor: %r' % values)
+    return [_cursor_unvalue_(v) for v in values]
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+request metrics of handlers and routes, exposed in Prometheus text format.
+"""
+import threading
+import logging
+from tornado.web import RequestHandler
+from .timing import Histogram, DEFAULT_BUCKETS
+_logger = logging.getLogger('tornado.torexpress')
+
+
+def _label_(v):
+    return ('%s' % v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_(**kwargs):
+    return ','.join('%s="%s"' % (k, _label_(v)) for k, v in sorted(kwargs.items()))
+
+
+class Metrics(object):
+    """
+    Metrics: counters and latency histograms of requests kept by ExpressApplication, labeled by the handler class and
+    the route (pattern of the URLSpec matched in handler, '' for the handler itself):
+        - requests: number of requests by handler, route, method and status;
+        - latency: fixed-bucket histogram of request time in seconds by handler and route;
+        - errors: number of errors by handler, route and class of error (eg: NotFound, InvalidData);
+        - rows: number of records returned by handler and route.
+    """
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or DEFAULT_BUCKETS)
+        self.requests = dict()  # (handler, route, method, status) -> count
+        self.latency = dict()  # (handler, route) -> Histogram
+        self.errors = dict()  # (handler, route, error) -> count
+        self.rows = dict()  # (handler, route) -> count
+        self._lock = threading.Lock()
+
+    def observe(self, handler, route, method, status, seconds, error=None, rows=None):
+        key = (handler, route)
+        with self._lock:
+            k = (handler, route, method, status)
+            self.requests[k] = self.requests.get(k, 0) + 1
+            if error is not None:
+                k = (handler, route, error)
+                self.errors[k] = self.errors.get(k, 0) + 1
+            if rows:
+                self.rows[key] = self.rows.get(key, 0) + rows
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def render(self):
+        """render: render the metrics in Prometheus text exposition format."""
+        with self._lock:
+            requests, errors, rows = dict(self.requests), dict(self.errors), dict(self.rows)
+            latency = dict(self.latency)
+        lines = ['# HELP torexpress_requests_total Number of requests handled.',
+                 '# TYPE torexpress_requests_total counter']
+        for (handler, route, method, status), n in sorted(requests.items()):
+            lines.append('torexpress_requests_total{%s} %d' % (
+                _labels_(handler=handler, route=route, method=method, status=status), n))
+        lines.extend(['# HELP torexpress_request_duration_seconds Request time in seconds.',
+                      '# TYPE torexpress_request_duration_seconds histogram'])
+        for (handler, route), histogram in sorted(latency.items()):
+            stats = histogram.stats()
+            labels = _labels_(handler=handler, route=route)
+            cumulative = 0
+            for le, n in zip(stats['buckets'], stats['counts']):
+                cumulative += n
+                lines.append('torexpress_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, le, cumulative))
+            lines.append('torexpress_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, stats['count']))
+            lines.append('torexpress_request_duration_seconds_sum{%s} %f' % (labels, stats['sum']))
+            lines.append('torexpress_request_duration_seconds_count{%s} %d' % (labels, stats['count']))
+        lines.extend(['# HELP torexpress_errors_total Number of errors by class of error.',
+                      '# TYPE torexpress_errors_total counter'])
+        for (handler, route, error), n in sorted(errors.items()):
+            lines.append('torexpress_errors_total{%s} %d' % (_labels_(handler=handler, route=route, error=error), n))
+        lines.extend(['# HELP torexpress_rows_total Number of records returned.',
+                      '# TYPE torexpress_rows_total counter'])
+        for (handler, route), n in sorted(rows.items()):
+            lines.append('torexpress_rows_total{%s} %d' % (_labels_(handler=handler, route=route), n))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(RequestHandler):
+    """MetricsHandler: serves the metrics of application in Prometheus text format, it's routed to the path of setting
+    `metrics_path` ('/metrics' by default) when setting `metrics` is enabled.
+    """
+    def get(self):
+        metrics = getattr(self.application, 'metrics', None)
+        if metrics is None:
+            self.send_error(404)
+            return
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
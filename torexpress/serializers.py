@@ -1,6 +1,9 @@
 from sqlalchemy.orm.query import Query
 from . import exceptions
+from .cache import Memmory
+from .helpers import encode_cursor, model_info
 import types
+import operator
 import logging
 _logger = logging.getLogger('tornado.torexpress')
 
@@ -15,9 +18,10 @@ def restruct_ext_fields(cls, extend_fields):
     if not extend_fields:
         return {}
     result = {}
+    relationships = model_info(cls).relationships
     for x, y in map(_f_, extend_fields):
         _logger.debug('[1]restruct_ext_fields> %s: %s', x, y)
-        if x not in cls.__mapper__.relationships.keys():
+        if x not in relationships:
             continue
         if x not in result:
             result[x] = [y] if y else []
@@ -27,42 +31,135 @@ def restruct_ext_fields(cls, extend_fields):
     return result
 
 
+class SerializePlan(object):
+    """SerializePlan: a compiled plan to serialize instances of model `cls` into dictionaries with the given
+    include_fields and extend_fields. All the column and relationship checks are done once when the plan is built,
+    serializing an instance is only a tight loop of attribute getters.
+    """
+    __slots__ = ('cls', 'fields', 'getter', 'relations')
+
+    def __init__(self, cls, include_fields=None, extend_fields=None):
+        info = model_info(cls)
+        columns = info.attributes
+        fields = set(include_fields or columns) | set(info.pk_names)
+        if hasattr(cls, '__handler__') and cls.__handler__._meta.invisible:
+            fields -= set(cls.__handler__._meta.invisible)
+        if not fields <= columns:
+            raise exceptions.BadRequest(message='Column(s) "%s" does not exists!' % ','.join(list(fields - columns)))
+        self.cls = cls
+        self.fields = tuple(sorted(fields))
+        if len(self.fields) > 1:
+            self.getter = operator.attrgetter(*self.fields)
+        elif self.fields:
+            self.getter = lambda o, _g=operator.attrgetter(self.fields[0]): (_g(o),)
+        else:
+            self.getter = lambda o: ()
+        self.relations = list()
+        for relkey, relext in restruct_ext_fields(cls, extend_fields).items():
+            rcls = info.targets[relkey]
+            rcolumns = model_info(rcls).attributes
+            rrelations = model_info(rcls).relationships
+            incs = [x for x in relext if x.find('.') < 0 and x in rcolumns]
+            exts = [x for x in relext if x.find('.') > 0 or x in rrelations]
+            self.relations.append((relkey, get_serialize_plan(rcls, include_fields=incs, extend_fields=exts)))
+
+    def __call__(self, inst):
+        if isinstance(inst, (list, tuple, types.GeneratorType)):
+            return [self(x) for x in inst]
+        if not isinstance(inst, self.cls):
+            return inst
+        result = dict(zip(self.fields, self.getter(inst)))
+        for relkey, plan in self.relations:
+            result[relkey] = plan(getattr(inst, relkey))
+        return result
+
+
+_serialize_plans_ = Memmory(max_size=1024)
+
+
+def get_serialize_plan(cls, include_fields=None, extend_fields=None):
+    """get_serialize_plan: return the cached SerializePlan of (cls, include_fields, extend_fields), build it if it is
+    not cached yet.
+    """
+    key = (cls,
+           tuple(sorted(set(include_fields))) if include_fields else None,
+           tuple(sorted(set(extend_fields))) if extend_fields else None)
+    plan = _serialize_plans_.get(key)
+    if plan is None:
+        plan = SerializePlan(cls, include_fields=include_fields, extend_fields=extend_fields)
+        _serialize_plans_.set(key, plan)
+    return plan
+
+
 def serialize_object(cls, inst, include_fields=None, extend_fields=None):
     """serialize_object: serialize a single object from model instance into a dictionary.
     """
-    _logger.debug('Inst: %s | %s', inst, type(inst))
-    if isinstance(inst, (list, tuple, types.GeneratorType)):
-        return map(lambda x: serialize_object(cls, x, include_fields=include_fields, extend_fields=extend_fields),
-                   inst)
-    if not isinstance(inst, cls):
-        return inst
-    _logger.debug('serialize_object> extend_fields: %s', extend_fields)
-    include_fields = list(set(include_fields or cls.__mapper__.c.keys()) | set(cls.__table__.primary_key.columns.keys()))
-    if hasattr(cls, '__handler__') and cls.__handler__._meta.invisible:
-        include_fields = list(set(include_fields) - set(cls.__handler__._meta.invisible))
-    if not set(include_fields) <= set(cls.__mapper__.c.keys()):
-        raise exceptions.BadRequest(message='Column(s) "%s" does not exists!' % ','.join(list(
-            set(include_fields) - set(cls.__mapper__.c.keys())
-        )))
-    result = dict((k, getattr(inst, k)) for k in include_fields)
-    # TODO: Extend fields ....
-    if extend_fields:
-        _logger.debug('serialize_object: extend_fields=%s', extend_fields)
-        for relkey, relext in restruct_ext_fields(cls, extend_fields).items():
-            rinst = cls.__mapper__.relationships[relkey]
-            _logger.debug('====> %s: %s', relkey, relext)
-            #if rinst.direction.name in ('MANYTOONE', 'ONETOONE'):
-            incs = filter(lambda x: x.find('.') < 0 and x in rinst.mapper.class_.__mapper__.c.keys(), relext)
-            #[relext] if (relext and relext.find('.') < 0 and relext in rinst.mapper.class_.__mapper__.c.keys()) else None
-            exts = filter(lambda x: x.find('.') > 0 or x in rinst.mapper.class_.__mapper__.relationships.keys(), relext)
-            #[relext] if relext and incs is None else None
-            _logger.debug('inc=%s, ext=%s', incs, exts)
-            result[relkey] = serialize_object(rinst.mapper.class_, getattr(inst, relkey),
-                                              include_fields=incs,
-                                              extend_fields=exts)
-    #for relkey, relobj in cls.__mapper__.relationships.items():
-    #    pass
-    return result
+    return get_serialize_plan(cls, include_fields=include_fields, extend_fields=extend_fields)(inst)
+
+
+def serialize_projection(cls, inst, include_fields=None, keys=None):
+    """serialize_projection: serialize a query of model `cls` into a list of dictionaries by querying only the columns
+    of include_fields, result tuples are turned into dictionaries directly without loading any ORM instance.
+    Only for the case that no relationship is extended.
+    When a list of columns `keys` is given, they are queried along and a tuple of (list_of_dictionaries,
+    values_of_keys_in_last_row) is returned instead.
+    """
+    fields = get_serialize_plan(cls, include_fields=include_fields).fields
+    columns = [getattr(cls, f) for f in fields]
+    if not keys:
+        return [dict(zip(fields, row)) for row in inst.with_entities(*columns)]
+    n = len(fields)
+    rows = inst.with_entities(*(columns + list(keys))).all()
+    return [dict(zip(fields, row[:n])) for row in rows], (tuple(rows[-1][n:]) if rows else None)
+
+
+class StreamedRecords(object):
+    """StreamedRecords: an iterable of serialized records of query `inst`, it's consumed row by row when writing the
+    response so the result is never materialized in memory as a whole. The rows are fetched in batches of `yield_per`
+    with a server side cursor if the dialect supports, except when relationships are extended (eager loaded collections
+    can not be fetched in batches).
+    When `keys` (columns for keyset pagination) are given, the values of keys in the last row are kept for the cursor of
+    next page. Call `tail()` after iteration to get the envelope keys which are only known at the end.
+    """
+    def __init__(self, cls, inst, include_fields=None, extend_fields=None, projection=False, keys=None, limit=None,
+                 yield_per=100):
+        self.cls = cls
+        self.inst = inst
+        self.include_fields = include_fields
+        self.extend_fields = extend_fields
+        self.projection = projection
+        self.keys = list(keys or [])
+        self.limit = limit
+        self.yield_per = yield_per
+        self.count = 0
+        self.last_keys = None
+
+    def __iter__(self):
+        cls, inst, keys = self.cls, self.inst, self.keys
+        if not self.extend_fields:
+            inst = inst.execution_options(stream_results=True).yield_per(self.yield_per)
+        if self.projection:
+            fields = get_serialize_plan(cls, include_fields=self.include_fields).fields
+            n = len(fields)
+            for row in inst.with_entities(*([getattr(cls, f) for f in fields] + keys)):
+                self.count += 1
+                if keys:
+                    self.last_keys = tuple(row[n:])
+                yield dict(zip(fields, row[:n]))
+        else:
+            plan = get_serialize_plan(cls, include_fields=self.include_fields, extend_fields=self.extend_fields)
+            for obj in inst:
+                self.count += 1
+                if keys:
+                    self.last_keys = tuple(getattr(obj, c.key) for c in keys)
+                yield plan(obj)
+
+    def tail(self):
+        result = {'__count': self.count}
+        if self.keys:
+            result['__next'] = encode_cursor(self.last_keys) \
+                if self.last_keys and self.limit is not None and 0 <= self.limit <= self.count else None
+        return result
 
 
 def serialize_query(cls, inst, include_fields=None, extend_fields=None):
@@ -86,18 +183,30 @@ def serialize(cls, inst, include_fields=None, extend_fields=None):
 
 import simplejson as json
 import uuid
+import decimal
 import datetime
-#import decimal
+
+
+def ext_default(obj):
+    """ext_default: encode the types which JSON does not support natively into strings (or numbers), raises TypeError
+    for the others. It's shared by ExtJsonEncoder and all the JSON codecs.
+    """
+    if isinstance(obj, datetime.datetime):
+        return obj.strftime('%Y-%m-%dT%H:%M:%S.%f')  # isoformat()
+    if isinstance(obj, datetime.date):
+        return obj.strftime('%Y-%m-%d')  # isoformat()
+    if isinstance(obj, datetime.time):
+        return obj.strftime('%H:%M:%S.%f')  # isoformat()
+    if isinstance(obj, uuid.UUID):
+        return '%s' % uuid.UUID(obj.hex)
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError('%r is not JSON serializable' % (obj, ))
 
 
 class ExtJsonEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.strftime('%Y-%m-%dT%H:%M:%S.%f')  # isoformat()
-        if isinstance(obj, datetime.date):
-            return obj.strftime('%Y-%m-%d')  # isoformat()
-        if isinstance(obj, datetime.time):
-            return obj.strftime('%H:%M:%S.%f')  # isoformat()
-        if isinstance(obj, uuid.UUID):
-            return '%s' % uuid.UUID(obj.hex)
-        return json.JSONEncoder.default(self, obj)
+        try:
+            return ext_default(obj)
+        except TypeError:
+            return json.JSONEncoder.default(self, obj)
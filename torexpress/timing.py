@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+per-request timing spans and the sinks they are reported to.
+Spans are timed by time.monotonic, or by the `monotonic` package (the backport of it) on Python 2 when it's installed.
+Otherwise timeit.default_timer is used on Python 2, which is time.time on POSIX and not monotonic: a span measured
+across an adjustment of the system clock may be wrong, even negative.
+"""
+import socket
+import threading
+import logging
+from collections import OrderedDict
+try:
+    from time import monotonic as clock
+except ImportError:
+    try:
+        from monotonic import monotonic as clock
+    except ImportError:
+        from timeit import default_timer as clock  # Python 2 has no monotonic clock in stdlib.
+_logger = logging.getLogger('tornado.torexpress')
+
+PHASES = ('parse', 'auth', 'query-build', 'execute', 'serialize', 'encode', 'commit')
+
+
+class Span(object):
+    """Span: a context manager measures the time of a phase into the SpanRecorder."""
+    __slots__ = ('recorder', 'name', 'started')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.add(self.name, clock() - self.started)
+
+
+class SpanRecorder(object):
+    """
+    SpanRecorder: records the seconds spent on the named phases of a request (see PHASES), spans of the same name are
+    accumulated. eg:
+        with handler.timing.span('execute'):
+            rows = query.all()
+    """
+    enabled = True
+
+    def __init__(self):
+        self.started = clock()
+        self.spans = OrderedDict()
+
+    def span(self, name):
+        return Span(self, name)
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def total(self):
+        return clock() - self.started
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullRecorder(object):
+    """NullRecorder: the recorder of requests when there's no sink, all the spans are no-op."""
+    enabled = False
+    spans = {}
+    _span_ = _NullSpan()
+
+    def span(self, name):
+        return self._span_
+
+    def add(self, name, seconds):
+        pass
+
+    def total(self):
+        return 0.0
+
+
+null_recorder = NullRecorder()
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Histogram: fixed-bucket histogram of seconds, `counts[i]` is the number of values <= buckets[i] (not
+    cumulative), the last one is for the values beyond all buckets.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = 0
+        for b in self.buckets:
+            if value <= b:
+                break
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def stats(self):
+        with self._lock:
+            return {'buckets': self.buckets, 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class HistogramSink(object):
+    """HistogramSink: keeps a Histogram of each phase (and 'total') of each handler in memory, see stats()."""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = dict()  # (handler name, phase) -> Histogram
+        self._lock = threading.Lock()
+
+    def _histogram_(self, key):
+        h = self.histograms.get(key)
+        if h is None:
+            with self._lock:
+                h = self.histograms.setdefault(key, Histogram(self.buckets))
+        return h
+
+    def record(self, handler, recorder):
+        name = handler.__class__.__name__
+        for phase, seconds in recorder.spans.items():
+            self._histogram_((name, phase)).observe(seconds)
+        self._histogram_((name, 'total')).observe(recorder.total())
+
+    def stats(self):
+        result = dict()
+        for (name, phase), h in self.histograms.items():
+            result.setdefault(name, dict())[phase] = h.stats()
+        return result
+
+
+class StatsdSink(object):
+    """StatsdSink: sends the spans as statsd timers (`prefix.Handler.phase:ms|ms`) by UDP, all the spans of a request in
+    one datagram. Errors of sending are ignored, metrics should never fail a request.
+    """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='torexpress'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, handler, recorder):
+        name = '%s.%s' % (self.prefix, handler.__class__.__name__)
+        lines = ['%s.%s:%.3f|ms' % (name, phase, seconds * 1000) for phase, seconds in recorder.spans.items()]
+        lines.append('%s.total:%.3f|ms' % (name, recorder.total() * 1000))
+        try:
+            self._socket.sendto('\n'.join(lines), self.address)
+        except socket.error, e:
+            _logger.debug('Sending timing to statsd failed: %s', e)
+
+
+class ServerTimingSink(object):
+    """ServerTimingSink: adds the spans to the `Server-Timing` header of response (when it's not flushed yet), so they
+    show up in the network panel of browsers.
+    """
+    def record(self, handler, recorder):
+        if getattr(handler, '_headers_written', False):
+            return
+        timings = ['%s;dur=%.2f' % (phase, seconds * 1000) for phase, seconds in recorder.spans.items()]
+        timings.append('total;dur=%.2f' % (recorder.total() * 1000))
+        handler.set_header('Server-Timing', ', '.join(timings))
+
+
+TIMING_SINKS = {
+    'histogram': HistogramSink,
+    'statsd': StatsdSink,
+    'server-timing': ServerTimingSink,
+}
+
+
+def create_timing_sinks(conf):
+    """create_timing_sinks: create the sinks of request timing from the `timing` setting of application.
+    `conf` can be None or False (timing is disabled), or a list of:
+        - an object already implemented record(handler, recorder): used as it is;
+        - a string of sink name: 'histogram', 'statsd' or 'server-timing';
+        - a dictionary with key 'sink' and the other keys as kwargs of the sink, eg:
+            {'sink': 'statsd', 'host': '127.0.0.1', 'port': 8125, 'prefix': 'api'}
+    """
+    if not conf:
+        return []
+    result = list()
+    for x in (conf if isinstance(conf, (list, tuple)) else [conf]):
+        if hasattr(x, 'record'):
+            result.append(x)
+            continue
+        if isinstance(x, dict):
+            kwargs = dict(x)
+            name = kwargs.pop('sink', None)
+        else:
+            kwargs = {}
+            name = x
+        sink_cls = TIMING_SINKS.get(('%s' % name).lower())
+        if sink_cls is None:
+            raise Exception('Unknown timing sink "%s".' % name)
+        result.append(sink_cls(**kwargs))
+    return result